@@ -7,3 +7,16 @@ WLAN_SSID = 'wifi-name'
 WLAN_KEY = 'wifi-pass'
 
 TIME_ZONE = 8
+
+# keep config2 as a compact binary snapshot instead of json
+CONFIG2_BINARY = True
+
+# biggest message accepted from the server in bytes, after inflating, a
+# config push takes about 150 bytes per device
+WS_MAX_MESSAGE = 65536
+
+# permessage-deflate window bits for the server link (9-15), 0 disables
+WS_DEFLATE_BITS = 10
+
+# report device states as a compact bitset, sent only when it changes
+REPORT_BINARY = False
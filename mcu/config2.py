@@ -1,51 +1,382 @@
 # config received from server
 
+from micropython import const
 import json
+import os
 import re
+import struct
+import time
 
+import config as C
 import utils as U
+import net_utils as N
+import jsonstream as J
+
+_CONFIG_FILE = 'config2.json'
+_SNAPSHOT_FILE = 'config2.bin'
+_SNAPSHOT_TEMP = 'config2.tmp'
+_PATCH_FILE = 'config2.patch'
+_READ_CHUNK = const(256)
+
+# binary snapshot, all big endian:
+#   header  magic(4) format(1) revision(4) devices(2) years(2)
+#   device  len(name) len(ip) len(mac) flags(1) port(2) name ip mac [wol(102)]
+#           3 * (count(1), count * uint16) for workday/holiday/anyday,
+#           count 0xFF means no rules, bit 15 marks a shutdown time,
+#           port is the tcp probe port or 0, format 1 has no port
+#   year    year(2) known bitmap(46) holiday bitmap(46)
+_SNAPSHOT_MAGIC = b'WOM2'
+_SNAPSHOT_FORMAT = const(2)
+_SNAPSHOT_HEADER = '!4sBIHH'
+_SNAPSHOT_DEVICE = '!BBBBH'
+_SNAPSHOT_DEVICE_V1 = '!BBBB'
+_SNAPSHOT_HAS_WOL = const(0x01)
+_SNAPSHOT_NO_ICMP = const(0x02)
+_SNAPSHOT_NO_RULES = const(0xFF)
+_SNAPSHOT_SHUTDOWN = const(0x8000)
+_WOL_SIZE = const(102)
 
 class Config2:
     def __init__(self):
         self.devices = {}
-        self.days = {}
+        self.days = Calendar()
         self.version = 0
+        self.revision = 0 # config version assigned by the server
+        self.order = [] # device names sorted, index of a device in reports
+        self._timelines = {}
 
-    def save(self, cfg):
+    def save(self, reader):
+        # reader is a JsonReader positioned at the config object
         try:
-            self._apply(cfg)
-            with open('config2.json', 'w') as file:
-                json.dump(cfg, file)
-                U.log_info('Config2.save', self.devices, self.days)
+            self._apply(reader)
+            if not C.CONFIG2_BINARY or not self._save_snapshot():
+                # json when the snapshot is off or could not be written,
+                # a stale snapshot would shadow it on load
+                _remove(_SNAPSHOT_FILE)
+                self._dump()
+            _remove(_PATCH_FILE)
+            U.log_info('Config2.save', self._summary())
         except Exception as ex:
             U.log_err('Config2.save', ex)
 
     def load(self):
+        begin = time.ticks_ms()
         try:
-            with open('config2.json', 'r') as file:
-                cfg = json.load(file)
-                self._apply(cfg)
-                U.log_info('Config2.load', self.devices, self.days)
+            if not self._read_snapshot():
+                with open(_CONFIG_FILE, 'rb') as file:
+                    self._apply(J.JsonReader(lambda: file.read(_READ_CHUNK)))
+            self._replay()
+            U.log_info('Config2.load', '%dms' % time.ticks_diff(time.ticks_ms(), begin), self._summary())
         except Exception as ex:
             U.log_err('Config2.load', ex)
 
-    def _apply(self, cfg):
-        if not cfg.get('devices'):
-            raise Exception('invalid config2 devices')
+    def patch(self, patch):
+        # apply a config_patch in place, False when it does not fit our revision
+        try:
+            if patch.get('base') != self.revision:
+                U.log_info('Config2.patch', 'base mismatch', patch.get('base'), self.revision)
+                return False
+            self._patch(patch)
+            with open(_PATCH_FILE, 'a') as file:
+                file.write(json.dumps(patch))
+                file.write('\n')
+            U.log_info('Config2.patch', self._summary())
+            return True
+        except Exception as ex:
+            U.log_err('Config2.patch', ex)
+            return False
+
+    def _summary(self):
+        # counts only, the whole config is too big for one log line
+        return 'revision %s, %d devices, %d days' % (self.revision, len(self.devices), len(self.days))
+
+    def _replay(self):
+        try:
+            with open(_PATCH_FILE, 'r') as file:
+                for line in file:
+                    patch = json.loads(line)
+                    if patch.get('base') != self.revision:
+                        raise Exception('broken patch journal')
+                    self._patch(patch)
+        except OSError:
+            pass # no journal
+
+    def _apply(self, reader):
+        # devices and days are built entry by entry as they are parsed,
+        # the raw document and a decoded dict are never held at once
         devices = {}
-        for name, item in cfg.get('devices').items():
-            devices[name] = Device(item)
-
-        if not cfg.get('days'):
-            raise Exception('invalid config2 days')    
-        days = {}
-        for item in cfg.get('days'):
-            days[item.get('date')] = item.get('type')
-        
+        days = Calendar()
+        revision = 0
+        for key in reader.items():
+            if key == 'devices':
+                for name in reader.items():
+                    devices[name] = Device(reader.value())
+            elif key == 'days':
+                for _ in reader.elements():
+                    item = reader.value()
+                    days.set(item.get('date'), item.get('type'))
+            elif key == 'version':
+                revision = reader.value() or 0
+            else:
+                reader.value()
+
+        if not devices:
+            raise Exception('invalid config2 devices')
+        if not len(days):
+            raise Exception('invalid config2 days')
+
         self.devices = devices
         self.days = days
+        self.revision = revision
+        self._compiled()
+
+    def _patch(self, patch):
+        devices = patch.get('devices') or {}
+        days = patch.get('days') or {}
+
+        # build everything first so a bad patch leaves the config untouched
+        added = {}
+        for name, item in (devices.get('set') or {}).items():
+            added[name] = Device(item)
+        dates = [(item.get('date'), item.get('type')) for item in days.get('set') or ()]
+        for date, _ in dates:
+            _parse_date(date)
+
+        for name in devices.get('del') or ():
+            self.devices.pop(name, None)
+        self.devices.update(added)
+        for date in days.get('del') or ():
+            self.days.clear(date)
+        for date, day_type in dates:
+            self.days.set(date, day_type)
+
+        self.revision = patch.get('version') or 0
+        self._compiled()
+
+    def _compiled(self):
+        # refresh everything derived from the devices after a change
+        self.order = sorted(self.devices)
+        self._timelines = _compile_timelines(self.devices)
         self.version = (self.version + 1) & 0xFFFFFFFF
 
+    def _dump(self):
+        # written piece by piece from the compiled config
+        with open(_CONFIG_FILE, 'w') as file:
+            file.write('{"version":%s,"devices":{' % json.dumps(self.revision))
+            sep = ''
+            for name, dev in self.devices.items():
+                file.write(sep)
+                file.write(json.dumps(name))
+                file.write(':')
+                file.write(json.dumps(dev.to_dict()))
+                sep = ','
+            file.write('},"days":[')
+            sep = ''
+            for date, day_type in self.days.items():
+                file.write(sep)
+                file.write('{"date":"%s","type":"%s"}' % (date, day_type))
+                sep = ','
+            file.write(']}')
+
+    def _save_snapshot(self):
+        try:
+            self._write_snapshot()
+            return True
+        except Exception as ex:
+            U.log_err('Config2._save_snapshot', ex)
+            return False
+
+    def _write_snapshot(self):
+        # temp file renamed over the old one, littlefs replaces it in one
+        # step so a reset mid-write keeps the old snapshot
+        with open(_SNAPSHOT_TEMP, 'wb') as file:
+            file.write(struct.pack(_SNAPSHOT_HEADER, _SNAPSHOT_MAGIC, _SNAPSHOT_FORMAT,
+                self.revision & 0xFFFFFFFF, len(self.devices), len(self.days._years)))
+            for dev in self.devices.values():
+                name, ip, mac = dev.name.encode(), dev.ip.encode(), (dev.mac or '').encode()
+                flags = (_SNAPSHOT_HAS_WOL if dev.wol else 0) | (0 if dev.icmp else _SNAPSHOT_NO_ICMP)
+                file.write(struct.pack(_SNAPSHOT_DEVICE, len(name), len(ip), len(mac), flags, dev.port))
+                file.write(name)
+                file.write(ip)
+                file.write(mac)
+                if dev.wol:
+                    file.write(dev.wol)
+                for int_times in (dev.workday, dev.holiday, dev.anyday):
+                    if int_times is None:
+                        file.write(bytes((_SNAPSHOT_NO_RULES,)))
+                        continue
+                    file.write(bytes((len(int_times),)))
+                    for sign, mins in int_times:
+                        file.write(struct.pack('!H', mins | (_SNAPSHOT_SHUTDOWN if sign == '-' else 0)))
+            for year, bitmap in self.days._years.items():
+                file.write(struct.pack('!H', year))
+                file.write(bitmap)
+        os.rename(_SNAPSHOT_TEMP, _SNAPSHOT_FILE)
+
+    def _read_snapshot(self):
+        try:
+            with open(_SNAPSHOT_FILE, 'rb') as file:
+                data = file.read()
+        except OSError:
+            return False
+
+        try:
+            view = memoryview(data)
+            magic, fmt, revision, dev_count, year_count = struct.unpack_from(_SNAPSHOT_HEADER, data, 0)
+            if magic != _SNAPSHOT_MAGIC or fmt not in (1, _SNAPSHOT_FORMAT):
+                raise Exception('bad snapshot header')
+            pos = struct.calcsize(_SNAPSHOT_HEADER)
+            dev_format = _SNAPSHOT_DEVICE if fmt == _SNAPSHOT_FORMAT else _SNAPSHOT_DEVICE_V1
+            dev_size = struct.calcsize(dev_format)
+
+            devices = {}
+            for _ in range(0, dev_count):
+                fields = struct.unpack_from(dev_format, data, pos)
+                name_len, ip_len, mac_len, flags = fields[:4]
+                pos += dev_size
+                dev = Device.__new__(Device)
+                dev.icmp = not flags & _SNAPSHOT_NO_ICMP
+                dev.port = fields[4] if len(fields) > 4 else 0
+                dev.name = bytes(view[pos:pos + name_len]).decode()
+                pos += name_len
+                dev.ip = bytes(view[pos:pos + ip_len]).decode()
+                pos += ip_len
+                dev.mac = bytes(view[pos:pos + mac_len]).decode() or None
+                pos += mac_len
+                dev.wol = None
+                if flags & _SNAPSHOT_HAS_WOL:
+                    dev.wol = bytes(view[pos:pos + _WOL_SIZE])
+                    pos += _WOL_SIZE
+                rules = []
+                for _ in range(0, 3):
+                    count = data[pos]
+                    pos += 1
+                    if count == _SNAPSHOT_NO_RULES:
+                        rules.append(None)
+                        continue
+                    int_times = []
+                    for _ in range(0, count):
+                        value, = struct.unpack_from('!H', data, pos)
+                        pos += 2
+                        int_times.append(('-' if value & _SNAPSHOT_SHUTDOWN else '+', value & ~_SNAPSHOT_SHUTDOWN))
+                    rules.append(int_times)
+                dev.workday, dev.holiday, dev.anyday = rules
+                devices[dev.name] = dev
+
+            days = Calendar()
+            for _ in range(0, year_count):
+                year, = struct.unpack_from('!H', data, pos)
+                pos += 2
+                days._years[year] = bytearray(view[pos:pos + _BITMAP_SIZE * 2])
+                pos += _BITMAP_SIZE * 2
+
+        except Exception as ex:
+            U.log_err('Config2._read_snapshot', 'fallback to json', ex)
+            return False
+
+        self.devices = devices
+        self.days = days
+        self.revision = revision
+        self._compiled()
+        return True
+
+    def due(self, day_type, time_prev, time_now):
+        # (sign, name) of every event in (time_prev, time_now] for day_type
+        mins, events = self._timelines.get(day_type) or self._timelines.get(None) or ((), ())
+        if time_now < time_prev: # passed midnight
+            time_prev = -1
+        return events[_bisect(mins, time_prev):_bisect(mins, time_now)]
+
+_DAYS_BEFORE = (0, 31, 59, 90, 120, 151, 181, 212, 243, 273, 304, 334)
+_BITMAP_SIZE = const(46) # ceil(366 / 8)
+
+class Calendar:
+    # day types as two day-of-year bitmaps per year: known and holiday
+    def __init__(self):
+        self._years = {} # year -> bytearray(known bitmap + holiday bitmap)
+
+    def __repr__(self):
+        return json.dumps({str(year): _count_bits(bitmap, 0) for year, bitmap in self._years.items()})
+
+    def __len__(self):
+        return sum(_count_bits(bitmap, 0) for bitmap in self._years.values())
+
+    def items(self):
+        # ('YYYY-MM-DD', day type) of every known day, in date order
+        for year in sorted(self._years):
+            bitmap = self._years[year]
+            for yday in range(0, 366):
+                byte, bit = yday >> 3, 1 << (yday & 0x7)
+                if bitmap[byte] & bit:
+                    month, day = _month_day(year, yday)
+                    day_type = 'holiday' if bitmap[_BITMAP_SIZE + byte] & bit else 'workday'
+                    yield '%04d-%02d-%02d' % (year, month, day), day_type
+
+    def set(self, date, day_type):
+        year, month, day = _parse_date(date)
+        bitmap = self._years.get(year)
+        if not bitmap:
+            bitmap = bytearray(_BITMAP_SIZE * 2)
+            self._years[year] = bitmap
+        yday = _yday(year, month, day)
+        byte, bit = yday >> 3, 1 << (yday & 0x7)
+        bitmap[byte] |= bit
+        if day_type == 'holiday':
+            bitmap[_BITMAP_SIZE + byte] |= bit
+        else:
+            bitmap[_BITMAP_SIZE + byte] &= ~bit
+
+    def clear(self, date):
+        year, month, day = _parse_date(date)
+        bitmap = self._years.get(year)
+        if bitmap:
+            yday = _yday(year, month, day)
+            byte, bit = yday >> 3, 1 << (yday & 0x7)
+            bitmap[byte] &= ~bit
+            bitmap[_BITMAP_SIZE + byte] &= ~bit
+
+    def get(self, year, month, day):
+        # 'workday', 'holiday' or None straight from the rtc date fields
+        bitmap = self._years.get(year)
+        if not bitmap:
+            return None
+        yday = _yday(year, month, day)
+        byte, bit = yday >> 3, 1 << (yday & 0x7)
+        if not bitmap[byte] & bit:
+            return None
+        return 'holiday' if bitmap[_BITMAP_SIZE + byte] & bit else 'workday'
+
+def _parse_date(date):
+    if type(date) != str or len(date) != 10:
+        raise Exception('invalid date %s' % date)
+    year, month, day = int(date[0:4]), int(date[5:7]), int(date[8:10])
+    if not 1 <= month <= 12 or not 1 <= day <= 31:
+        raise Exception('invalid date %s' % date)
+    return year, month, day
+
+def _yday(year, month, day):
+    yday = _DAYS_BEFORE[month - 1] + day - 1
+    if month > 2 and year % 4 == 0 and (year % 100 != 0 or year % 400 == 0):
+        yday += 1
+    return yday
+
+def _month_day(year, yday):
+    leap = 1 if year % 4 == 0 and (year % 100 != 0 or year % 400 == 0) else 0
+    for month in range(12, 0, -1):
+        first = _DAYS_BEFORE[month - 1] + (leap if month > 2 else 0)
+        if yday >= first:
+            return month, yday - first + 1
+    return 1, 1
+
+def _count_bits(bitmap, offset):
+    count = 0
+    for pos in range(offset, offset + _BITMAP_SIZE):
+        byte = bitmap[pos]
+        while byte:
+            byte &= byte - 1
+            count += 1
+    return count
+
 class Device:
     def __init__(self, device):
         self.name = device.get('name')
@@ -56,39 +387,40 @@ class Device:
         self.workday = self._parse_times(device.get('workday'))
         self.holiday = self._parse_times(device.get('holiday'))
         self.anyday = self._parse_times(device.get('anyday'))
+        self.icmp, self.port = self._parse_probe(device.get('probe'))
+        self.wol = self._make_wol()
 
     def __repr__(self):
-        return json.dumps({
+        return json.dumps(self.to_dict())
+
+    def to_dict(self):
+        return {
             'name': self.name,
             'ip': self.ip,
             'mac': self.mac,
-            'workday': self.workday,
-            'holiday': self.holiday,
-            'anyday': self.anyday,
-        })
+            'workday': _format_times(self.workday),
+            'holiday': _format_times(self.holiday),
+            'anyday': _format_times(self.anyday),
+            'probe': self._format_probe(),
+        }
 
     def has_schedule(self):
         return self.holiday is not None or self.workday is not None or self.anyday is not None
 
-    def check_startup(self, date, time_prev, time_now):
-        if config2.days.get(date) == 'workday' and self.workday:
-            return self._check_times(self.workday, '+', time_prev, time_now)
-        elif config2.days.get(date) == 'holiday' and self.holiday:
-            return self._check_times(self.holiday, '+', time_prev, time_now)
-        elif self.anyday:
-            return self._check_times(self.anyday, '+', time_prev, time_now)
-        else:
-            return False
+    def target(self):
+        # what ping_sweep probes, a plain ip for the default icmp probe
+        if self.icmp and not self.port:
+            return self.ip
+        return (self.ip, self.icmp, self.port)
 
-    def check_shutdown(self, date, time_prev, time_now):
-        if config2.days.get(date) == 'workday' and self.workday:
-            return self._check_times(self.workday, '-', time_prev, time_now)
-        elif config2.days.get(date) == 'holiday' and self.holiday:
-            return self._check_times(self.holiday, '-', time_prev, time_now)
-        elif self.anyday:
-            return self._check_times(self.anyday, '-', time_prev, time_now)
+    def times(self, day_type):
+        # rules in effect on a day of day_type, workday/holiday fall back to anyday
+        if day_type == 'workday' and self.workday:
+            return self.workday
+        elif day_type == 'holiday' and self.holiday:
+            return self.holiday
         else:
-            return False
+            return self.anyday
 
     def _parse_times(self, str_times):
         if type(str_times) != list:
@@ -103,10 +435,74 @@ class Device:
             int_times.append((sign, mins))
         return int_times
 
-    def _check_times(self, times, sign, time_prev, time_now):
-        for time in times:
-            if time[0] == sign and time_prev <= time[1] <= time_now:
-                return True
-        return False
+    def _parse_probe(self, probe):
+        # "icmp", "tcp:<port>" or both comma separated, default icmp
+        if not probe:
+            return True, 0
+        icmp, port = False, 0
+        for method in probe.split(','):
+            method = method.strip()
+            res = re.match(r'tcp:(\d+)$', method)
+            if method == 'icmp':
+                icmp = True
+            elif res and 0 < int(res.group(1)) < 65536:
+                port = int(res.group(1))
+            else:
+                raise Exception('invalid probe %s' % probe)
+        return icmp, port
+
+    def _format_probe(self):
+        if self.icmp and not self.port:
+            return None
+        methods = ['icmp'] if self.icmp else []
+        if self.port:
+            methods.append('tcp:%d' % self.port)
+        return ','.join(methods)
+
+    def _make_wol(self):
+        if not self.mac:
+            return None
+        try:
+            return N.make_wol(self.mac)
+        except U.CustomEx as cex:
+            U.log_err('Device._make_wol', self.name, self.mac, cex)
+            return None
+
+def _format_times(int_times):
+    if int_times is None:
+        return None
+    return ['%s%d:%02d' % (sign, mins // 60, mins % 60) for sign, mins in int_times]
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+def _compile_timelines(devices):
+    # day type -> (sorted minutes, [(sign, name)]) aligned with the minutes
+    timelines = {}
+    for day_type in ('workday', 'holiday', None):
+        items = []
+        for name, dev in devices.items():
+            for sign, mins in dev.times(day_type) or ():
+                items.append((mins, sign, name))
+        items.sort()
+        timelines[day_type] = (
+            [item[0] for item in items],
+            [(item[1], item[2]) for item in items],
+        )
+    return timelines
+
+def _bisect(arr, value):
+    # index of the first item > value
+    low, high = 0, len(arr)
+    while low < high:
+        mid = (low + high) >> 1
+        if value < arr[mid]:
+            high = mid
+        else:
+            low = mid + 1
+    return low
 
 config2 = Config2()
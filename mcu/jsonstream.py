@@ -0,0 +1,175 @@
+# incremental json reader, walks a document chunk by chunk so big
+# configs never have to be held in RAM as one string or one dict
+
+from micropython import const
+
+_CHUNK = const(256)
+
+# byte values, micropython cannot test an int against bytes with `in`
+_WS = (0x20, 0x09, 0x0D, 0x0A)
+_NUM = tuple(b'+-0123456789.eE')
+_ESCAPES = {
+    ord('"'): ord('"'),
+    ord('\\'): ord('\\'),
+    ord('/'): ord('/'),
+    ord('b'): 0x08,
+    ord('f'): 0x0C,
+    ord('n'): 0x0A,
+    ord('r'): 0x0D,
+    ord('t'): 0x09,
+}
+
+def chunks(data, size=_CHUNK):
+    # read function over an in-memory str/bytes/memoryview
+    pos = [0]
+    def read():
+        begin = pos[0]
+        pos[0] = begin + size
+        chunk = data[begin:begin + size]
+        return chunk.encode('utf-8') if isinstance(chunk, str) else chunk
+    return read
+
+class JsonReader:
+    def __init__(self, read):
+        self._read = read # returns the next chunk, empty at the end
+        self._buf = b''
+        self._pos = 0
+
+    def items(self):
+        # yields every key of an object, caller must consume each value
+        self._expect(ord('{'))
+        if self._peek() == ord('}'):
+            self._pos += 1
+            return
+        while True:
+            if self._peek() != ord('"'):
+                raise ValueError('json: expect key')
+            key = self._string()
+            self._expect(ord(':'))
+            yield key
+            if self._delimit(ord('}')):
+                return
+
+    def elements(self):
+        # yields once per array element, caller must consume each value
+        self._expect(ord('['))
+        if self._peek() == ord(']'):
+            self._pos += 1
+            return
+        while True:
+            yield None
+            if self._delimit(ord(']')):
+                return
+
+    def value(self):
+        char = self._peek()
+        if char == ord('{'):
+            obj = {}
+            for key in self.items():
+                obj[key] = self.value()
+            return obj
+        elif char == ord('['):
+            arr = []
+            for _ in self.elements():
+                arr.append(self.value())
+            return arr
+        elif char == ord('"'):
+            return self._string()
+        elif char == ord('t'):
+            self._literal(b'true')
+            return True
+        elif char == ord('f'):
+            self._literal(b'false')
+            return False
+        elif char == ord('n'):
+            self._literal(b'null')
+            return None
+        elif char >= 0 and char in _NUM:
+            return self._number()
+        else:
+            raise ValueError('json: unexpected %s' % ('end' if char < 0 else chr(char)))
+
+    def _fill(self):
+        if self._pos < len(self._buf):
+            return True
+        chunk = self._read()
+        if not chunk:
+            return False
+        self._buf = chunk if isinstance(chunk, bytes) else bytes(chunk)
+        self._pos = 0
+        return True
+
+    def _peek(self):
+        # next significant byte without consuming it, -1 at the end
+        while self._fill():
+            char = self._buf[self._pos]
+            if char not in _WS:
+                return char
+            self._pos += 1
+        return -1
+
+    def _take(self):
+        if not self._fill():
+            raise ValueError('json: unexpected end')
+        char = self._buf[self._pos]
+        self._pos += 1
+        return char
+
+    def _expect(self, char):
+        if self._peek() != char:
+            raise ValueError('json: expect %s' % chr(char))
+        self._pos += 1
+
+    def _delimit(self, close):
+        char = self._peek()
+        self._pos += 1
+        if char == close:
+            return True
+        if char != ord(','):
+            raise ValueError('json: expect , or %s' % chr(close))
+        return False
+
+    def _literal(self, word):
+        for char in word:
+            if self._take() != char:
+                raise ValueError('json: bad literal')
+
+    def _number(self):
+        out = bytearray()
+        while self._fill() and self._buf[self._pos] in _NUM:
+            out.append(self._buf[self._pos])
+            self._pos += 1
+        text = out.decode()
+        if '.' in text or 'e' in text or 'E' in text:
+            return float(text)
+        return int(text)
+
+    def _string(self):
+        self._expect(ord('"'))
+        out = bytearray()
+        while True:
+            if not self._fill():
+                raise ValueError('json: unterminated string')
+            buf, pos = self._buf, self._pos
+            # copy the plain run up to the next quote or escape in one go
+            end = buf.find(b'"', pos)
+            esc = buf.find(b'\\', pos)
+            if esc >= 0 and (end < 0 or esc < end):
+                end = esc
+            if end < 0:
+                out += buf[pos:]
+                self._pos = len(buf)
+                continue
+            out += buf[pos:end]
+            self._pos = end + 1
+            if buf[end] == ord('"'):
+                return out.decode('utf-8')
+
+            char = self._take()
+            if char == ord('u'):
+                code = int(bytes(self._take() for _ in range(4)).decode(), 16)
+                out += chr(code).encode('utf-8')
+            elif char in _ESCAPES:
+                out.append(_ESCAPES[char])
+            else:
+                raise ValueError('json: bad escape')
@@ -8,12 +8,14 @@ from config2 import config2
 from server import Server
 from monitor import Monitor
 from worker import Worker
+from metrics import metrics
 
 async def main():
     led_init = machine.PWM(machine.Pin(12, machine.Pin.OUT), freq=500)
     led_server = machine.PWM(machine.Pin(13, machine.Pin.OUT), freq=500)
 
     try:
+        log_task = asyncio.create_task(U.log_writer())
         U.log_info('main', 'starting')
 
         server = Server()
@@ -38,6 +40,8 @@ async def main():
             server_task,
             asyncio.create_task(monitor.run(server)),
             asyncio.create_task(worker.run(monitor)),
+            asyncio.create_task(metrics.run(server)),
+            log_task,
         )
 
     except Exception as ex:
@@ -45,6 +49,7 @@ async def main():
         led_init.duty(50)
         led_server.duty(50)
         await asyncio.sleep(30)
+        U.log_flush()
         machine.reset()
 
 asyncio.run(main())
@@ -0,0 +1,11 @@
+# websocket masking compiled by the viper emitter, kept in its own module
+# because a port without viper rejects the decorator at compile time,
+# websocket.py imports it inside a try and falls back to plain python
+
+import micropython
+
+# XOR buf[:length] with the 4-byte mask in place
+@micropython.viper
+def mask(buf: ptr8, mask_bits: ptr8, length: int):
+    for i in range(0, length):
+        buf[i] ^= mask_bits[i & 3]
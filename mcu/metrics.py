@@ -0,0 +1,121 @@
+from micropython import const
+from array import array
+import gc
+import time
+import uasyncio as asio
+
+import utils as U
+
+_METRICS_TICK = const(1000) # ms, loop lag and free memory sampling
+_METRICS_INTERVAL = const(300) # ticks between stats messages
+
+# upper bounds of the histogram buckets, one more bucket takes the rest
+_BOUNDS = {
+    'ping_rtt_ms': (2, 5, 10, 20, 50, 100, 200, 500, 1000),
+    'sweep_ms': (100, 250, 500, 1000, 2000, 3000, 5000),
+    'dispatch_ms': (10, 50, 100, 500, 1000, 5000, 20000),
+    'reconnect_ms': (500, 1000, 5000, 15000, 60000, 300000),
+    'loop_lag_ms': (1, 5, 10, 20, 50, 100, 500),
+}
+
+class Histogram:
+    # fixed buckets in a preallocated array, observing never allocates
+    def __init__(self, bounds):
+        self._bounds = bounds
+        self._counts = array('I', [0] * (len(bounds) + 1))
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+    def observe(self, value):
+        idx = 0
+        bounds = self._bounds
+        while idx < len(bounds) and value > bounds[idx]:
+            idx += 1
+        self._counts[idx] += 1
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+
+    def reset(self):
+        for idx in range(0, len(self._counts)):
+            self._counts[idx] = 0
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+    def to_dict(self):
+        return {
+            'le': self._bounds,
+            'counts': list(self._counts),
+            'count': self.count,
+            'sum': self.total,
+            'max': self.max,
+        }
+
+class Metrics:
+    def __init__(self):
+        self.counters = {} # since boot
+        self.gauges = {} # low-water marks, reset after each stats message
+        self.histograms = {} # reset after each stats message
+        self.rtt = {} # ip -> last ping round trip, ms
+        self._uptime = 0 # ms, summed from the sampling ticks
+        for name in _BOUNDS:
+            self.histograms[name] = Histogram(_BOUNDS[name])
+
+    def incr(self, name, count=1):
+        self.counters[name] = self.counters.get(name, 0) + count
+
+    def low(self, name, value):
+        if value < self.gauges.get(name, value + 1):
+            self.gauges[name] = value
+
+    def observe(self, name, value):
+        self.histograms[name].observe(value)
+
+    async def run(self, server):
+        # samples loop lag and free memory every tick, the lag is how late
+        # the sleep wakes up, and reports every interval
+        ticks = 0
+        while True:
+            begin = time.ticks_ms()
+            await asio.sleep_ms(_METRICS_TICK)
+            elapsed = time.ticks_diff(time.ticks_ms(), begin)
+            self._uptime += elapsed
+            self.observe('loop_lag_ms', max(0, elapsed - _METRICS_TICK))
+            self.low('mem_free', gc.mem_free())
+
+            ticks += 1
+            if ticks < _METRICS_INTERVAL:
+                continue
+            ticks = 0
+            try:
+                # queued, goes out in one write with the next report, the
+                # monitor sends one at least every keepalive
+                if await server.send(self.to_report(), False):
+                    self.reset()
+            except Exception as ex:
+                U.log_err('Metrics.run', ex)
+
+    def reset(self):
+        self.gauges.clear()
+        for name in self.histograms:
+            self.histograms[name].reset()
+
+    def to_report(self):
+        histograms = {}
+        for name in self.histograms:
+            histograms[name] = self.histograms[name].to_dict()
+        return {
+            'type': 'stats',
+            'data': {
+                'uptime': self._uptime // 1000,
+                'counters': self.counters,
+                'gauges': self.gauges,
+                'histograms': histograms,
+                'rtt': self.rtt,
+            },
+        }
+
+metrics = Metrics()
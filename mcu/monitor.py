@@ -1,71 +1,264 @@
 from micropython import const
 import gc
+import heapq
+import struct
 import time
 import uasyncio as asio
 
+import config as C
 import utils as U
 import net_utils as N
 from config2 import config2
 
 _MONITOR_IDLE_TICK = const(60) # seconds
 _MONITOR_BUSY_TICK = const(15) # seconds
+_MONITOR_MAX_TICK = const(300) # seconds, stable devices back off up to this
+_MONITOR_NEAR_BEFORE = const(2) # minutes before a scheduled event
+_MONITOR_NEAR_AFTER = const(10) # minutes after it, the machine is booting or shutting down
 _MONITOR_BUSY_COUNT = const(6)
-_MONITOR_RETRY_TIMES = const(3)
+_MONITOR_RETRY_TIMES = const(3) # misses in a row before a device is offline
+_MONITOR_UP_TIMES = const(1) # replies in a row before a device is online
+_MONITOR_KEEPALIVE = const(120) # seconds, resend an unchanged report
+_MONITOR_FRESH_TTL = const(30) # seconds a ping reply is fresh enough to act on, over the busy tick
+
+# binary report: type(1) config revision(4) count(2) online bitset,
+# bit i is the device at config2.order[i], lowest bit first
+_REPORT_BINARY = const(0x01)
+_REPORT_HEADER = '!BIH'
+
+class _State:
+    # probe history of one device, online only flips on a confirmed change
+    def __init__(self):
+        self.online = False
+        self.known = False
+        self.hits = 0 # replies in a row
+        self.misses = 0 # misses in a row
+        self.fast = 0 # rounds left at the busy tick
+        self.probed = 0 # time of the last probe
+        self.reply = False # raw reply of the last probe
+        self.due = 0 # time of the next probe, matches its heap entry
+        self.interval = _MONITOR_IDLE_TICK # backoff for a stable device
+
+    def pending(self):
+        # a flip has started but is not confirmed yet
+        return (self.online and self.misses > 0) or (not self.online and self.hits > 0)
+
+    def update(self, reply):
+        # returns True when the confirmed state changed
+        if reply:
+            self.hits += 1
+            self.misses = 0
+        else:
+            self.misses += 1
+            self.hits = 0
+
+        if not self.known:
+            self.known = True
+            self.online = reply
+            return True
+        if not self.online and self.hits >= _MONITOR_UP_TIMES:
+            self.online = True
+            return True
+        if self.online and self.misses >= _MONITOR_RETRY_TIMES:
+            self.online = False
+            return True
+        return False
 
 class Monitor:
     def __init__(self):
         self._version = 0
-        self.devices = {}
+        self.devices = {} # name -> confirmed online state
         self.busy_event = asio.Event()
-        self._busy_cnt = 0
+        self._states = {}
+        self._queue = [] # heap of (next probe time, name)
+        self._probing = {} # name -> event of an on-demand probe in flight
+        self._report = None # last report sent
+        self._report_at = 0
 
         self._server = None
-    
+
     async def run(self, server):
         try:
             self._server = server
-            self._sync_config()
             await self._ping_devices()
 
         except Exception as ex:
             U.log_err('Monitor.run', ex)
             raise
 
+    def watch(self, names):
+        # probe these devices now and then at the busy tick for a while,
+        # e.g. right after they were sent a wakeup or shutdown
+        now = time.time()
+        for name in names:
+            state = self._states.get(name)
+            if state:
+                state.fast = _MONITOR_BUSY_COUNT
+                self._schedule(name, state, now)
+        self.busy_event.set()
+
+    async def fresh(self, names, ttl=_MONITOR_FRESH_TTL):
+        # last ping reply of each device, re-probed first when older than
+        # ttl, callers asking about the same device share one probe
+        now = time.time()
+        stale = []
+        waits = []
+        for name in names:
+            state = self._states.get(name)
+            if not state or now - state.probed <= ttl:
+                continue
+            event = self._probing.get(name)
+            if event:
+                waits.append(event)
+            elif name not in stale and config2.devices.get(name):
+                self._probing[name] = asio.Event()
+                stale.append(name)
+
+        if stale:
+            try:
+                results = await N.ping_sweep([config2.devices[name].target() for name in stale])
+                now = time.time()
+                for name, reply in zip(stale, results):
+                    state = self._states.get(name)
+                    if state and reply is not None:
+                        state.reply = reply
+                        state.probed = now
+            finally:
+                for name in stale:
+                    self._probing.pop(name).set()
+
+        for event in waits:
+            await event.wait()
+
+        return [self._reply(name) for name in names]
+
+    def _reply(self, name):
+        state = self._states.get(name)
+        if not state or not state.probed:
+            return self.devices.get(name, False)
+        return state.reply
+
+    def _schedule(self, name, state, when):
+        # older heap entries of the device go stale and are skipped
+        state.due = when
+        heapq.heappush(self._queue, (when, name))
+
     def _sync_config(self):
         if self._version == config2.version:
             return
+        self._version = config2.version
 
-        for name in self.devices:
+        for name in list(self._states):
             if not config2.devices.get(name):
-                del self.devices[name]
+                del self._states[name]
+                self.devices.pop(name, None)
 
-        for name, _ in config2.devices.items():
-            if name not in self.devices:
+        now = time.time()
+        for name in config2.devices:
+            if name not in self._states:
+                state = _State()
+                self._states[name] = state
                 self.devices[name] = False
-    
+                self._schedule(name, state, now)
+
     async def _ping_devices(self):
         while True:
-            begin = time.ticks_ms()
-            if self._busy_cnt >= 0:
-                self._busy_cnt -= 1
+            self._sync_config()
+            now = time.time()
+
+            names = []
+            while self._queue and self._queue[0][0] <= now:
+                due, name = heapq.heappop(self._queue)
+                state = self._states.get(name)
+                if state and state.due == due and name not in names:
+                    names.append(name)
+
+            changed = False
+            if names:
+                results = await N.ping_sweep([config2.devices[name].target() for name in names])
+                day_type, minute = self._today()
+
+                for name, reply in zip(names, results):
+                    state = self._states.get(name)
+                    if not state:
+                        continue # removed by a config change meanwhile
+                    if reply is None:
+                        # cut off by the sweep deadline, goes first next round
+                        self._schedule(name, state, now)
+                        continue
+                    state.probed = now
+                    state.reply = reply
+                    if state.fast > 0:
+                        state.fast -= 1
+                    flipped = state.update(reply)
+                    if flipped:
+                        self.devices[name] = state.online
+                        changed = True
+                    self._schedule(name, state, now + self._interval(name, state, flipped, day_type, minute))
+                U.log_dbg('Monitor.run', 'devices status', len(names), self.devices)
+                gc.collect()
+
+            # the keepalive goes out even when no device was due
+            await self._send_report(changed)
 
-            for name, dev in config2.devices.items():
-                self.devices[name] = await N.do_ping(dev.ip)
-            U.log_dbg('Monitor.run', 'devices status', self.devices)
+            # sleep to the next due probe, a watch() cuts it short
+            wait = _MONITOR_MAX_TICK
+            if self._queue:
+                wait = max(1, self._queue[0][0] - time.time())
+            self.busy_event.clear()
+            try:
+                await asio.wait_for(self.busy_event.wait(), min(wait, _MONITOR_KEEPALIVE))
+            except asio.TimeoutError:
+                pass
 
-            await self._server.send({
+    def _interval(self, name, state, flipped, day_type, minute):
+        # busy tick around actions and schedule boundaries, stable
+        # devices back off exponentially
+        if state.fast > 0 or state.pending() or flipped or self._near_schedule(name, day_type, minute):
+            state.interval = _MONITOR_IDLE_TICK
+            return _MONITOR_BUSY_TICK
+        interval = state.interval
+        state.interval = min(interval * 2, _MONITOR_MAX_TICK)
+        return interval
+
+    def _near_schedule(self, name, day_type, minute):
+        dev = config2.devices.get(name)
+        for _, mins in (dev and dev.times(day_type)) or ():
+            if -_MONITOR_NEAR_BEFORE <= minute - mins <= _MONITOR_NEAR_AFTER:
+                return True
+        return False
+
+    def _today(self):
+        year, month, day, _, hour, minute = U.rtc.datetime()[:6]
+        return config2.days.get(year, month, day), hour * 60 + minute
+
+    async def _send_report(self, changed):
+        # only confirmed changes are reported, plus a keepalive so the
+        # server keeps seeing us online
+        now = time.time()
+        if not changed and now - self._report_at < _MONITOR_KEEPALIVE:
+            return
+
+        if C.REPORT_BINARY:
+            report = self._encode_report()
+            if report == self._report and now - self._report_at < _MONITOR_KEEPALIVE:
+                return
+        else:
+            report = {
                 "type": "report",
                 "data": self.devices,
-            })
-            gc.collect()
-
-            while True:
-                if self.busy_event.is_set():
-                    self.busy_event.clear()
-                    self._busy_cnt = _MONITOR_BUSY_COUNT
-                tick = _MONITOR_BUSY_TICK if self._busy_cnt > 0 else _MONITOR_IDLE_TICK
-                end = time.ticks_ms()
-                dura = tick * 1000 - (end - begin)
-                if dura <= 0:
-                    break
-                await asio.sleep(min(dura, _MONITOR_BUSY_TICK))
+            }
+        if await self._server.send(report):
+            self._report = report
+            self._report_at = now
+
+    def _encode_report(self):
+        order = config2.order
+        count = len(order)
+        head = struct.calcsize(_REPORT_HEADER)
+        report = bytearray(head + (count + 7) // 8)
+        struct.pack_into(_REPORT_HEADER, report, 0, _REPORT_BINARY, config2.revision & 0xFFFFFFFF, count)
+        for idx in range(0, count):
+            if self.devices.get(order[idx]):
+                report[head + (idx >> 3)] |= 1 << (idx & 0x7)
+        return report
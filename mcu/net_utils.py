@@ -1,14 +1,16 @@
-from errno import EAGAIN
-import ctypes
+from micropython import const
+from errno import EAGAIN, EALREADY, ECONNREFUSED, ECONNRESET, EINPROGRESS
 import network
 import socket
 import struct
 import random
 import time
 import uasyncio as asio
+import uasyncio.core
 
 import config as C
 import utils as U
+from metrics import metrics
 
 EPOCH = 0
 if time.gmtime(0)[0] == 1970:
@@ -68,147 +70,389 @@ def sync_ntp_time():
 def epoch_now():
     return time.time() - EPOCH - C.TIME_ZONE * 3600
 
-async def send_wol(mac):
+_SEND_TIMEOUT = const(1000) # ms
+
+# park the current task on uasyncio's poller until sock is ready
+def _wait_read(sock):
+    yield uasyncio.core._io_queue.queue_read(sock)
+
+def _wait_write(sock):
+    yield uasyncio.core._io_queue.queue_write(sock)
+
+async def _sendto(sock, buf, addr):
+    while True:
+        try:
+            return sock.sendto(buf, addr)
+        except OSError as err:
+            if err.errno != EAGAIN:
+                raise
+        await _wait_write(sock)
+
+def make_wol(mac):
+    # magic packet: 6 * 0xFF followed by the mac repeated 16 times
+    if not mac or len(mac) != 17:
+        raise U.CustomEx('bad mac')
     try:
-        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, 1)
-        sock.setblocking(False)
+        mac_bin = bytes(int(mac[idx * 3:idx * 3 + 2], 16) for idx in range(0, 6))
+    except ValueError:
+        raise U.CustomEx('bad mac')
+    return b'\xff' * 6 + mac_bin * 16
 
-        buf = bytearray(6 + 16 * 6)
-        struct.pack_into('6B', buf, 0, 0xFF, 0xFF, 0xFF, 0xFF, 0xFF, 0xFF)
-
-        if len(mac) != 17:
-            raise U.CustomEx('bad mac')
-        mac_num = [0, 0, 0, 0, 0, 0]
-        for idx in range(0, 6):
-            mac_num[idx] = int(mac[idx * 3:idx * 3 + 2], 16)
-        print(mac, mac_num)
-        for i in range(0, 16):
-            struct.pack_into('6B', buf, 6 + i * 6, *mac_num)
-        print(buf)
-
-        for _ in range(0, 10): # 1000ms
-            try:
-                size = sock.sendto(buf, (BOARDCAST, 9))
-                if size != len(buf):
-                    raise U.CustomEx("bad size")
-                else:
-                    U.log_dbg('send_wol', mac, 'wol ok')
-                    return True
-            except OSError as err:
-                if err.errno != EAGAIN:
-                    raise
-                await asio.sleep_ms(100)
-        else:
-            raise U.CustomEx('timeout')
+_WOL_PORT = const(9)
+_SHUTDOWN_PORT = const(40004)
+_SHUTDOWN_PACKET = b'wom_shutdown'
+_BURST_REPEAT = const(3)
+_BURST_INTERVAL = const(1000) # ms
 
-    except U.CustomEx as cex:
-        U.log_info('send_wol', mac, cex)
+async def send_wol(packet):
+    return await send_burst((packet,), (), 1)
+
+async def send_shutdown(ip):
+    return await send_burst((), (ip,), 1)
+
+async def send_burst(packets, ips, repeat=_BURST_REPEAT, interval=_BURST_INTERVAL):
+    # send every wol packet and shutdown request `repeat` times on one
+    # socket, rounds share a timer so the burst takes (repeat - 1) * interval
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, 1)
+    try:
+        sock.setblocking(False)
+        ok = True
+        for rnd in range(0, repeat):
+            if rnd:
+                await asio.sleep_ms(interval)
+            for packet in packets:
+                ok = await _send(sock, packet, (BOARDCAST, _WOL_PORT)) and ok
+            for ip in ips:
+                ok = await _send(sock, _SHUTDOWN_PACKET, (ip, _SHUTDOWN_PORT)) and ok
+        return ok
 
     finally:
         sock.close()
 
-async def send_shutdown(ip):
+async def _send(sock, buf, addr):
     try:
-        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, 1)
-        sock.setblocking(False)
+        size = await asio.wait_for_ms(_sendto(sock, buf, addr), _SEND_TIMEOUT)
+        if size != len(buf):
+            raise U.CustomEx("bad size")
+        U.log_dbg('send_burst', addr[0], addr[1], 'send ok')
+        return True
 
-        buf = b'wom_shutdown'
-        for _ in range(0, 10): # 1000ms
-            try:
-                size = sock.sendto(buf, (ip, 40004))
-                if size != len(buf):
-                    raise U.CustomEx("bad size")
-                else:
-                    U.log_dbg('send_shutdown', ip, 'shutdown ok')
-                    return True
-            except OSError as err:
-                if err.errno != EAGAIN:
-                    raise
-                await asio.sleep_ms(100)
-        else:
-            raise U.CustomEx('timeout')
+    except asio.TimeoutError:
+        U.log_info('send_burst', addr[0], addr[1], 'timeout')
 
     except U.CustomEx as cex:
-        U.log_info('send_shutdown', ip, cex)
+        U.log_info('send_burst', addr[0], addr[1], cex)
 
-    finally:
-        sock.close()
+    return False
 
 PING_SIZE = 64
-PING_PACKET = { # packet header descriptor
-    "type": ctypes.UINT8 | 0,
-    "code": ctypes.UINT8 | 1,
-    "checksum": ctypes.UINT16 | 2,
-    "id": ctypes.UINT16 | 4,
-    "seq": ctypes.INT16 | 6,
-    "timestamp": ctypes.UINT64 | 8,
-}
+# echo request: type(1) code(1) checksum(2) id(2) seq(2) timestamp(8) payload
+_PING_STAMP = '!HQ' # seq and timestamp, at offset 6
+
+_PING_TIMEOUT = const(3000) # ms
+_PING_RECV_SIZE = const(256)
+
+def _ones_sum(data):
+    # folded 16-bit ones' complement sum, odd length padded with zero
+    size = len(data)
+    cs = 0
+    for pos in range(0, size - 1, 2):
+        cs += (data[pos] << 8) + data[pos + 1]
+    if size & 0x1:
+        cs += data[size - 1] << 8
+    while cs >= 0x10000:
+        cs = (cs & 0xffff) + (cs >> 16)
+    return cs
+
+class Pinger:
+    # one long-lived raw socket shared by all probes, replies are
+    # handed to the waiting coroutine by icmp seq
+    def __init__(self):
+        self._sock = None
+        self._id = random.randint(0, 65535)
+        self._seq = 0
+        self._waiters = {} # seq -> Event
+        self._events = [] # free Events
+        self._lock = asio.Lock() # one writer at a time on the io queue
+
+        # template with zero checksum, seq and timestamp, its sum is taken
+        # once and each probe only adds the fields it fills in
+        self._sbuf = bytearray(b'Q' * PING_SIZE)
+        struct.pack_into('!BBHHHQ', self._sbuf, 0, 8, 0, 0, self._id, 0, 0) # 8: ICMP_ECHO_REQUEST
+        self._sum = _ones_sum(self._sbuf)
+        self._rbuf = bytearray(_PING_RECV_SIZE)
+
+    async def ping(self, ip, timeout=_PING_TIMEOUT, track=True):
+        # track=False keeps the probe out of every metric, discovery pings
+        # whole subnets of mostly empty addresses
+        seq = self._next_seq()
+        event = self._events.pop() if self._events else asio.Event()
+        event.clear()
+        self._waiters[seq] = event
+        begin = time.ticks_us()
+        try:
+            await asio.wait_for_ms(self._exchange(ip, seq, event), timeout)
+            rtt = time.ticks_diff(time.ticks_us(), begin) // 1000
+            if track:
+                metrics.observe('ping_rtt_ms', rtt)
+                metrics.rtt[ip] = rtt
+            U.log_dbg('Pinger.ping', ip, 'recv ok')
+            return True
+
+        except asio.TimeoutError:
+            if track:
+                metrics.incr('ping_timeouts')
+            U.log_dbg('Pinger.ping', ip, 'timeout')
+            return False
+
+        except U.CustomEx as cex:
+            U.log_dbg('Pinger.ping', ip, cex)
+            return False
+
+        finally:
+            self._waiters.pop(seq, None)
+            self._events.append(event)
+
+    def close(self):
+        if self._sock:
+            self._sock.close()
+            self._sock = None
+
+    def _next_seq(self):
+        self._seq = (self._seq + 1) & 0xFFFF
+        return self._seq
+
+    def _open(self):
+        if not self._sock:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_RAW, 1)
+            sock.setblocking(False)
+            self._sock = sock
+            asio.create_task(self._read(sock))
+        return self._sock
+
+    def _fill(self, seq, stamp):
+        # rfc 1624, the fields were zero in the template
+        sbuf = self._sbuf
+        struct.pack_into(_PING_STAMP, sbuf, 6, seq, stamp)
+        cs = self._sum + seq + (stamp >> 16) + (stamp & 0xFFFF)
+        cs = (cs & 0xFFFF) + (cs >> 16)
+        cs = (cs & 0xFFFF) + (cs >> 16)
+        sbuf[2] = (~cs >> 8) & 0xFF
+        sbuf[3] = ~cs & 0xFF
+
+    async def _exchange(self, ip, seq, event):
+        sock = self._open()
+        sbuf = self._sbuf
+        async with self._lock:
+            while True:
+                self._fill(seq, time.ticks_us() & 0xFFFFFFFF)
+                try:
+                    if sock.sendto(sbuf, (ip, 1)) != PING_SIZE:
+                        raise U.CustomEx("bad size")
+                    break
+                except OSError as err:
+                    if err.errno != EAGAIN:
+                        self.close()
+                        raise
+                await _wait_write(sock)
+        await event.wait()
+
+    async def _read(self, sock):
+        # sleeps on the poller while idle, wakes once per incoming packet
+        try:
+            while sock is self._sock:
+                await _wait_read(sock)
+                while True:
+                    try:
+                        size = sock.readinto(self._rbuf)
+                    except OSError as err:
+                        if err.errno != EAGAIN:
+                            raise
+                        size = None
+                    if not size:
+                        break
+
+                    # raw socket reads include the ip header, ihl words long
+                    rbuf = self._rbuf
+                    head = (rbuf[0] & 0xF) * 4
+                    # 0: ICMP_ECHO_REPLY
+                    if size >= head + 8 and rbuf[head] == 0 and (rbuf[head + 4] << 8 | rbuf[head + 5]) == self._id:
+                        event = self._waiters.pop(rbuf[head + 6] << 8 | rbuf[head + 7], None)
+                        if event:
+                            event.set()
+
+        except Exception as ex:
+            if sock is self._sock:
+                U.log_err('Pinger._read', ex)
+                self.close()
+
+pinger = Pinger()
 
 async def do_ping(ip):
+    return await pinger.ping(ip)
+
+_EISCONN = const(127) # esp-idf newlib value (lwip's own errno.h has 106), not in the errno module
+_TCP_UP = (ECONNREFUSED, ECONNRESET, _EISCONN)
+_TCP_LIMIT = const(4) # connects at once, well below the lwip socket table
+
+class _Slots:
+    # counting semaphore, uasyncio has none
+    def __init__(self, count):
+        self._free = count
+        self._event = asio.Event()
+
+    async def acquire(self):
+        while not self._free:
+            self._event.clear()
+            await self._event.wait()
+        self._free -= 1
+
+    def release(self):
+        self._free += 1
+        self._event.set()
+
+_tcp_slots = _Slots(_TCP_LIMIT)
+
+async def tcp_probe(ip, port, timeout=_PING_TIMEOUT):
+    # non-blocking connect, a syn-ack or an rst both prove the host is up,
+    # the timeout includes waiting for a free socket slot
+    try:
+        return await asio.wait_for_ms(_tcp_probe(ip, port), timeout)
+
+    except asio.TimeoutError:
+        U.log_dbg('tcp_probe', ip, port, 'timeout')
+        return False
+
+async def _tcp_probe(ip, port):
+    await _tcp_slots.acquire()
+    sock = None
     try:
-        sock = socket.socket(socket.AF_INET, socket.SOCK_RAW, 1)
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         sock.setblocking(False)
-        sock.connect((ip, 1))
-
-        sbuf = b'Q' * PING_SIZE
-        spkt = ctypes.struct(ctypes.addressof(sbuf), PING_PACKET, ctypes.BIG_ENDIAN)
-        spkt.type = 8  # ICMP_ECHO_REQUEST
-        spkt.code = 0
-        spkt.checksum = 0
-        spkt.id = random.randint(0, 65535)
-        spkt.seq = 1
-        spkt.timestamp = time.ticks_us()
-        spkt.checksum = _compute_checksum(sbuf)
-
-        # send ping
-        for _ in range(0, 10): # 1000ms
-            try:
-                size = sock.send(sbuf)
-                if size == len(sbuf):
-                    U.log_dbg('do_ping', ip, 'send ok')
-                    break
-                else:
-                    raise U.CustomEx("bad size")
-            except OSError as err:
-                if err.errno != EAGAIN:
-                    raise
-            await asio.sleep_ms(100)
-        else:
-            raise U.CustomEx("send timeout")
-
-        # recv ping
-        for _ in range(0, 30): # 3000ms
-            try:
-                rbuf = sock.recv(256)
-                view = memoryview(rbuf)
-                # 0: ICMP_ECHO_REPLY
-                rpkt = ctypes.struct(ctypes.addressof(view[20:]), PING_PACKET, ctypes.BIG_ENDIAN)
-                if rpkt.type == 0 and rpkt.id == spkt.id and rpkt.seq == spkt.seq:
-                    U.log_dbg('do_ping', ip, 'recv ok')
-                    return True
-            except OSError as err:
-                if err.errno != EAGAIN:
-                    raise
-                await asio.sleep_ms(100)
-        else:
-            raise U.CustomEx("recv timeout")
+        addr = socket.getaddrinfo(ip, port)[0][-1]
+        return await _connect(sock, addr)
 
-    except U.CustomEx as cex:
-        U.log_dbg('do_ping', ip, cex)
+    except OSError as err:
+        # out of sockets or no route, the probe just did not answer
+        U.log_dbg('tcp_probe', ip, port, err)
         return False
 
     finally:
-        sock.close()
+        if sock:
+            sock.close()
+        _tcp_slots.release()
 
-def _compute_checksum(data):
-    if len(data) & 0x1: # Odd number of bytes
-        data += b'\0'
-    cs = 0
-    for pos in range(0, len(data), 2):
-        b1 = data[pos]
-        b2 = data[pos + 1]
-        cs += (b1 << 8) + b2
-    while cs >= 0x10000:
-        cs = (cs & 0xffff) + (cs >> 16)
-    cs = ~cs & 0xffff
-    return cs
+async def _connect(sock, addr):
+    # connect again once writable, the error then tells how it ended
+    while True:
+        try:
+            sock.connect(addr)
+            return True
+        except OSError as err:
+            if err.errno in _TCP_UP:
+                return True
+            if err.errno != EINPROGRESS and err.errno != EALREADY:
+                return False
+        await _wait_write(sock)
+
+async def probe_host(ip, icmp=True, port=0, timeout=_PING_TIMEOUT):
+    # icmp and tcp race when both are set, the first to answer wins
+    if not port:
+        return await pinger.ping(ip, timeout)
+    if not icmp:
+        return await tcp_probe(ip, port, timeout)
+
+    done = asio.Event()
+    state = [False, 2] # answered, probes left
+
+    async def race(coro):
+        try:
+            up = await coro
+        except Exception:
+            up = False
+        state[0] = state[0] or up
+        state[1] -= 1
+        if up or not state[1]:
+            done.set()
+
+    tasks = (asio.create_task(race(pinger.ping(ip, timeout))), asio.create_task(race(tcp_probe(ip, port, timeout))))
+    try:
+        await done.wait()
+    finally:
+        # also when the sweep deadline cancels us mid-race
+        for task in tasks:
+            task.cancel()
+    return state[0]
+
+_SWEEP_LIMIT = const(32) # in-flight probes only cost an Event on the shared socket
+_SWEEP_TIMEOUT = const(5000) # ms, whole sweep
+
+async def ping_sweep(ips, limit=_SWEEP_LIMIT, timeout=_SWEEP_TIMEOUT):
+    # probe all targets, an ip or an (ip, icmp, port) for probe_host, at
+    # most `limit` probes in flight and one deadline for the whole sweep,
+    # returns a list of bool, None for targets the deadline cut off
+    count = len(ips)
+    results = [None] * count
+    cursor = [0]
+    begin = time.ticks_ms()
+
+    async def probe():
+        while cursor[0] < count:
+            index = cursor[0]
+            cursor[0] += 1
+            target = ips[index]
+            if isinstance(target, str):
+                results[index] = await pinger.ping(target)
+            else:
+                results[index] = await probe_host(*target)
+
+    try:
+        await asio.wait_for_ms(asio.gather(*[probe() for _ in range(min(limit, count))]), timeout)
+    except asio.TimeoutError:
+        U.log_dbg('ping_sweep', 'deadline', cursor[0], count)
+
+    metrics.observe('sweep_ms', time.ticks_diff(time.ticks_ms(), begin))
+    return results
+
+_DISCOVER_LIMIT = const(64)
+_DISCOVER_TIMEOUT = const(1000) # ms, per address
+_DISCOVER_BATCH = const(32)
+_DISCOVER_MAX = const(1024) # addresses, bigger subnets are cut around our ip
+
+async def discover(send, limit=_DISCOVER_LIMIT, timeout=_DISCOVER_TIMEOUT, batch=_DISCOVER_BATCH):
+    # ping every address of our subnet, `send(ips, done)` is awaited with
+    # each batch of live ones and once more with done, returns the count
+    own = U.ip2int(IP)
+    mask = U.ip2int(MASK)
+    first = (own & mask) + 1
+    last = (own | (~mask & 0xFFFFFFFF)) - 1
+    if last - first >= _DISCOVER_MAX:
+        first = max(first, own - _DISCOVER_MAX // 2)
+        last = min(last, first + _DISCOVER_MAX - 1)
+
+    cursor = [first]
+    found = []
+    count = [0]
+    lock = asio.Lock() # one batch on the link at a time
+
+    async def probe():
+        while cursor[0] <= last:
+            addr = cursor[0]
+            cursor[0] += 1
+            if addr == own:
+                continue
+            ip = U.int2ip(addr)
+            if not await pinger.ping(ip, timeout, False):
+                continue
+            found.append(ip)
+            count[0] += 1
+            if len(found) >= batch:
+                ips = found[:]
+                found.clear()
+                async with lock:
+                    await send(ips, False)
+
+    await asio.gather(*[probe() for _ in range(min(limit, last - first + 1))])
+    async with lock:
+        await send(found, True)
+    return count[0]
@@ -4,6 +4,7 @@ import errno
 import gc
 import hashlib
 import json
+import random
 import time
 import uasyncio as asio
 
@@ -11,9 +12,12 @@ import config as C
 import utils as U
 import net_utils as N
 import websocket as W
+import jsonstream as J
 from config2 import config2
+from metrics import metrics
 
-_SERVER_RETRY_DURATION = const(60) # seconds
+_SERVER_RETRY_MIN = const(1000) # ms
+_SERVER_RETRY_DURATION = const(60000) # ms
 _SERVER_TIMEOUT = const(180)
 
 class Server:
@@ -21,6 +25,7 @@ class Server:
         self._ws = None
         self._ready = False
         self._heartbeat = 0
+        self._discovering = False
 
         self._led = None
         self._worker = None
@@ -51,15 +56,24 @@ class Server:
         self._led = led
         self._worker = worker
 
+        clean = True
         while True:
-            await self._connect()
-            await self._recv()
+            await self._connect(clean)
+            clean = await self._recv()
             await self._ws.wait_closed()
 
-    async def _connect(self):
-        sleep = 0
+    async def _connect(self, clean):
+        # retry at once after a clean close, otherwise back off
+        # exponentially with jitter
+        begin = time.ticks_ms()
+        delay = _SERVER_RETRY_MIN
+        attempts = 0
         self._ws = None
 
+        if not clean:
+            await asio.sleep_ms(random.randint(delay // 2, delay))
+            delay *= 2
+
         while not self._ws:
             try:
                 gc.collect()
@@ -68,9 +82,12 @@ class Server:
                 self._ws = await W.connect(C.SVR_URL, {
                     'wom-token': token,
                     'wom-ip': N.IP,
-                })
-                U.log_dbg('Server._connect', 'connect ok')
+                }, C.WS_MAX_MESSAGE, C.WS_DEFLATE_BITS)
+                dura = time.ticks_diff(time.ticks_ms(), begin)
+                U.log_info('Server._connect', 'connect ok', '%dms' % dura, attempts + 1)
 
+                metrics.incr('reconnects')
+                metrics.observe('reconnect_ms', dura)
                 self._ready = True
                 self._heartbeat = time.time()
                 return
@@ -84,10 +101,12 @@ class Server:
                 if not isinstance(ex, U.CustomEx) and not (isinstance(ex, OSError) and ex.errno in self._ignores):
                     raise
 
-            sleep = min(sleep + 10, _SERVER_RETRY_DURATION)
-            await asio.sleep(sleep)
+            attempts += 1
+            await asio.sleep_ms(random.randint(delay // 2, delay))
+            delay = min(delay * 2, _SERVER_RETRY_DURATION)
 
-    async def send(self, pkt):
+    async def send(self, pkt, flush=True):
+        # flush=False queues the message to go out with the next send
         try:
             if not self._ws or not self._ws.open:
                 U.log_dbg('Server.send', 'connection closed')
@@ -96,9 +115,9 @@ class Server:
             if time.time() - self._heartbeat > _SERVER_TIMEOUT:
                 raise U.CustomEx('heartbeat loss')
 
-            msg = json.dumps(pkt)
+            msg = pkt if isinstance(pkt, (bytes, bytearray)) else json.dumps(pkt)
             U.log_dbg('Server.send', 'send', msg)
-            await self._ws.send(msg)
+            await self._ws.send(msg, flush)
             return True
 
         except Exception as ex:
@@ -115,28 +134,66 @@ class Server:
     async def _recv(self):
         try:
             while self._ws and self._ws.open:
-                msg = await self._ws.recv()
+                msg = await self._ws.recv_view()
 
                 if not msg:
-                    U.log_dbg('Server._recv', 'connection closed')
-                    return
+                    # a close of ours with an error code, like a message
+                    # over the limit, is not clean so the retry backs off
+                    U.log_dbg('Server._recv', 'connection closed', self._ws.close_code)
+                    return self._ws.close_code in (None, W.CLOSE_OK)
+
+                text, view = msg
+                if text:
+                    # the server sends "type" before "data", so a config
+                    # push is streamed into config2 instead of decoded whole
+                    reader = J.JsonReader(J.chunks(view))
+                    typ = None
+                    data = None
+                    for key in reader.items():
+                        if key == 'type':
+                            typ = reader.value()
+                        elif key == 'data' and typ == 'config':
+                            config2.save(reader)
+                            self._led.duty(0)
+                            break
+                        elif key == 'data':
+                            data = reader.value()
+                        else:
+                            reader.value()
+
+                    if typ == 'config' and data is not None:
+                        # "data" came first and was decoded whole, save it
+                        # anyway at the cost of the dict and its dump
+                        U.log_info('Server._recv', 'config data before type')
+                        config2.save(J.JsonReader(J.chunks(json.dumps(data))))
+                        data = None
+                        self._led.duty(0)
 
-                elif type(msg) is str:
-                    pkt = json.loads(msg)
-                    typ = pkt.get('type')
-                    if typ != 'flush':
-                        U.log_dbg('Server._recv', 'recv', msg)
+                    if C.DEBUG and typ != 'flush':
+                        U.log_dbg('Server._recv', 'recv', str(view, 'utf-8'))
 
-                    if typ == 'config':
-                        config2.save(pkt.get('data'))
-                        self._led.duty(0)
+                    if typ == 'config_patch':
+                        if not config2.patch(data or {}):
+                            await self.send({
+                                "type": "config_resync",
+                                "data": config2.revision,
+                            })
 
                     elif typ == 'wakeup' or typ == 'shutdown':
-                        await self._worker.do(pkt)
+                        await self._worker.do(typ, data)
 
                     elif typ == 'heartbeat':
                         self._heartbeat = time.time()
 
+                    elif typ == 'discover':
+                        if self._discovering:
+                            # the server refuses a second one, log it anyway
+                            U.log_info('Server._recv', 'discovery running, ignored', (data or {}).get('id'))
+                        else:
+                            # runs beside the receive loop, results are streamed
+                            self._discovering = True
+                            asio.create_task(self._discover(data or {}))
+
         except Exception as ex:
             self._ws.close()
             U.log_err_if('Server.recv', 'recv error', ex)
@@ -147,6 +204,29 @@ class Server:
                 raise
 
         U.log_dbg('Server._recv', 'task exit')
+        return False
+
+    async def _discover(self, data):
+        try:
+            ident = data.get('id')
+            begin = time.ticks_ms()
+            U.log_info('Server._discover', 'start', N.IP, N.MASK)
+
+            async def send(ips, done):
+                await self.send({
+                    "type": "discovered",
+                    "data": {"id": ident, "ips": ips, "done": done},
+                })
+
+            count = await N.discover(send)
+            U.log_info('Server._discover', 'done', count, '%dms' % time.ticks_diff(time.ticks_ms(), begin))
+
+        except Exception as ex:
+            U.log_err('Server._discover', ex)
+
+        finally:
+            self._discovering = False
+            gc.collect()
 
 def _sign_token():
     now = N.epoch_now()
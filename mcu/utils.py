@@ -1,5 +1,8 @@
+from micropython import const
 from machine import RTC
 from re import match
+import os
+import uasyncio as asio
 
 import config as C
 
@@ -8,7 +11,22 @@ class CustomEx(Exception):
 
 rtc = RTC()
 
-_file = open('wom.log', 'a')
+_LOG_FILE = 'wom.log'
+_LOG_FILES = const(3) # wom.log, wom.log.1, wom.log.2
+_LOG_FILE_SIZE = const(32768) # bytes before rotating
+_LOG_LINES = const(64) # ring buffer capacity
+_LOG_FLUSH = const(5000) # ms between batched writes
+_LOG_LINE_MAX = const(256) # longer lines are cut before they are queued
+
+# lines wait in a ring buffer and are written to flash in batches by
+# log_writer(), when it is full new lines are dropped and counted
+_ring = [None] * _LOG_LINES
+_ring_head = 0
+_ring_count = 0
+_ring_event = asio.Event()
+_file = None
+_file_size = 0
+log_dropped = 0
 
 def log_dbg(fn, *msg):
     if C.DEBUG:
@@ -16,26 +34,96 @@ def log_dbg(fn, *msg):
         print("DBG %02d/%02d %d:%d:%d %s:" % (month, day, hour, minute, second, fn), *msg)
 
 def log_info(fn, *msg):
-    (month, day, _, hour, minute, second) = rtc.datetime()[1:-1]
-    prefix = "INFO %02d/%02d %d:%d:%d %s:" % (month, day, hour, minute, second, fn)
-    print(prefix, *msg)
-    print(prefix, *msg, file=_file)
-    _file.flush()
+    _log('INFO', fn, msg)
 
 def log_err(fn, *msg):
+    _log('ERR', fn, msg)
+
+def log_err_if(cond, fn, *msg):
+    if C.DEBUG or cond:
+        _log('ERR', fn, msg)
+
+def _log(level, fn, msg):
+    global _ring_count, log_dropped
     (month, day, _, hour, minute, second) = rtc.datetime()[1:-1]
-    prefix = "ERR %02d/%02d %d:%d:%d %s:" % (month, day, hour, minute, second, fn)
+    prefix = "%s %02d/%02d %d:%d:%d %s:" % (level, month, day, hour, minute, second, fn)
     print(prefix, *msg)
-    print(prefix, *msg, file=_file)
+
+    if _ring_count >= _LOG_LINES:
+        log_dropped += 1
+        return
+    line = ' '.join([prefix] + [str(m) for m in msg])
+    if len(line) > _LOG_LINE_MAX:
+        line = line[:_LOG_LINE_MAX - 3] + '...'
+    _ring[(_ring_head + _ring_count) % _LOG_LINES] = line
+    _ring_count += 1
+    if _ring_count >= _LOG_LINES // 2:
+        _ring_event.set()
+
+async def log_writer():
+    # background task, one flash write per batch instead of per line
+    while True:
+        try:
+            await asio.wait_for_ms(_ring_event.wait(), _LOG_FLUSH)
+        except asio.TimeoutError:
+            pass
+        _ring_event.clear()
+        try:
+            log_flush()
+        except Exception as ex:
+            print('ERR log_writer:', ex)
+
+def log_flush():
+    # also called synchronously before a reset
+    global _ring_head, _ring_count, log_dropped, _file_size
+    if not _ring_count and not log_dropped:
+        return
+
+    lines = []
+    while _ring_count:
+        lines.append(_ring[_ring_head])
+        _ring[_ring_head] = None
+        _ring_head = (_ring_head + 1) % _LOG_LINES
+        _ring_count -= 1
+    if log_dropped:
+        lines.append('ERR log: %d lines dropped' % log_dropped)
+        log_dropped = 0
+    lines.append('')
+    text = '\n'.join(lines)
+
+    if _file_size + len(text) > _LOG_FILE_SIZE:
+        _rotate()
+    _open().write(text)
     _file.flush()
+    _file_size += len(text)
 
-def log_err_if(cond, fn, *msg):
-    if C.DEBUG or cond:
-        (month, day, _, hour, minute, second) = rtc.datetime()[1:-1]
-        prefix = "ERR %02d/%02d %d:%d:%d %s:" % (month, day, hour, minute, second, fn)
-        print(prefix, *msg)
-        print(prefix, *msg, file=_file)
-        _file.flush()
+def _open():
+    global _file, _file_size
+    if not _file:
+        _file = open(_LOG_FILE, 'a')
+        try:
+            _file_size = os.stat(_LOG_FILE)[6]
+        except OSError:
+            _file_size = 0
+    return _file
+
+def _rotate():
+    global _file, _file_size
+    if _file:
+        _file.close()
+        _file = None
+    for idx in range(_LOG_FILES - 1, 0, -1):
+        older = '%s.%d' % (_LOG_FILE, idx)
+        newer = '%s.%d' % (_LOG_FILE, idx - 1) if idx > 1 else _LOG_FILE
+        try:
+            os.remove(older)
+        except OSError:
+            pass
+        try:
+            os.rename(newer, older)
+        except OSError:
+            pass
+    _file_size = 0
 
 def ip2int(ip):
     res = match(r'(\d+)\.(\d+)\.(\d+)\.(\d+)', ip)
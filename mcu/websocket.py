@@ -1,16 +1,30 @@
 from micropython import const
 import binascii
 import errno
+import io
 import random
 import re
 import socket
 import ssl
 import struct
+import time
 import uasyncio.core
 import uasyncio.stream
 
 import utils as U
 
+# permessage-deflate, the deflate module (1.21+) inflates and, when
+# built with compression, compresses. older ports can still inflate with
+# zlib.DecompIO
+try:
+    import deflate
+except ImportError:
+    deflate = None
+try:
+    from zlib import DecompIO
+except ImportError:
+    DecompIO = None
+
 # Opcodes
 _OP_CONT = const(0x0)
 _OP_TEXT = const(0x1)
@@ -20,7 +34,7 @@ _OP_PING = const(0x9)
 _OP_PONG = const(0xA)
 
 # Close codes
-_CLOSE_OK = const(1000)
+CLOSE_OK = const(1000)
 _CLOSE_GOING_AWAY = const(1001)
 _CLOSE_PROTOCOL_ERROR = const(1002)
 _CLOSE_DATA_NOT_SUPPORTED = const(1003)
@@ -30,7 +44,48 @@ _CLOSE_TOO_BIG = const(1009)
 _CLOSE_MISSING_EXTN = const(1010)
 _CLOSE_BAD_CONDITION = const(1011)
 
-async def connect(url, headers=None):
+_MAX_SIZE = const(16384) # default max message size
+_RECV_SIZE = const(512) # initial receive buffer
+_SEND_SIZE = const(256) # initial send buffer
+_DEFLATE_MIN = const(64) # smaller messages are not worth compressing
+_DEFLATE_TAIL = b'\x00\x00\xff\xff'
+# tail plus an empty final block, so inflaters that want a complete
+# stream accept a sync-flushed message
+_INFLATE_TAIL = b'\x00\x00\xff\xff\x03\x00'
+_RSV1 = const(0x40)
+
+_DNS_TTL = const(600) # seconds
+
+_dns_cache = {} # (host, port) -> (addrinfo, expire time)
+_compressing = None # deflate can compress on this build, checked once
+
+# XOR buf[:length] with the 4-byte mask in place
+def _mask_py(buf, mask_bits, length):
+    for i in range(0, length):
+        buf[i] ^= mask_bits[i & 3]
+
+try:
+    from mask_viper import mask as _mask
+except Exception: # no viper emitter on this port, the import fails to compile
+    _mask = _mask_py
+
+def _can_compress():
+    # a port may ship deflate without compression, try it once
+    global _compressing
+    if _compressing is None:
+        _compressing = False
+        if deflate:
+            try:
+                stream = deflate.DeflateIO(io.BytesIO(), deflate.RAW, 9)
+                stream.write(b'\x00')
+                stream.close()
+                _compressing = True
+            except Exception as ex:
+                U.log_info('websocket._can_compress', 'plain frames', ex)
+    return _compressing
+
+async def connect(url, headers=None, max_size=_MAX_SIZE, deflate_bits=0):
+    # deflate_bits: window bits offered for permessage-deflate, 0 disables
     match = re.match(r'(wss?)://([A-Za-z0-9-\.]+)(?:\:([0-9]+))?(/.*)?', url)
     if not match:
         raise ValueError('Invalid url %s' % url)
@@ -49,22 +104,41 @@ async def connect(url, headers=None):
 
     U.log_dbg('websocket.connect', 'start %s' % url)
 
-    stream = await _open_connection(host, port, protocol == 'wss')
+    stream = None
+    try:
+        stream = await _open_connection(host, port, protocol == 'wss')
+        return await _upgrade(stream, url, host, port, path, headers, max_size, deflate_bits)
+    except Exception:
+        if stream:
+            stream.close()
+        # the address may be what broke, resolve afresh next time
+        _dns_cache.pop((host, port), None)
+        raise
+
+async def _upgrade(stream, url, host, port, path, headers, max_size, deflate_bits):
 
     # Sec-WebSocket-Key is 16 bytes of random base64 encoded
     key = binascii.b2a_base64(bytes(random.getrandbits(8) for _ in range(16)))[:-1]
 
-    stream.write(b'GET %s HTTP/1.1\r\n' % (path or '/'))
-    stream.write(b'Host: %s:%d\r\n' % (host, port))
-    stream.write(b'Connection: Upgrade\r\n')
-    stream.write(b'Upgrade: websocket\r\n')
-    stream.write(b'Sec-WebSocket-Key: %s\r\n' % key)
-    stream.write(b'Sec-WebSocket-Version: 13\r\n')
-    stream.write(b'Origin: %s\r\n' % url)
+    # the whole upgrade request goes out as one write
+    lines = [
+        b'GET %s HTTP/1.1\r\n' % (path or '/'),
+        b'Host: %s:%d\r\n' % (host, port),
+        b'Connection: Upgrade\r\n',
+        b'Upgrade: websocket\r\n',
+        b'Sec-WebSocket-Key: %s\r\n' % key,
+        b'Sec-WebSocket-Version: 13\r\n',
+        b'Origin: %s\r\n' % url,
+    ]
     if headers:
         for k, v in headers.items():
-            stream.write(b'%s: %s\r\n' % (k, v))
-    stream.write(b'\r\n')
+            lines.append(b'%s: %s\r\n' % (k, v))
+    if deflate_bits and (deflate or DecompIO):
+        lines.append(b'Sec-WebSocket-Extensions: permessage-deflate; client_no_context_takeover; '
+            b'server_no_context_takeover; client_max_window_bits=%d; server_max_window_bits=%d\r\n'
+            % (deflate_bits, deflate_bits))
+    lines.append(b'\r\n')
+    stream.write(b''.join(lines))
 
     await stream.drain()
 
@@ -72,21 +146,27 @@ async def connect(url, headers=None):
     if not header.startswith(b'HTTP/1.1 101 '):
         raise U.CustomEx('Invalid protocol header')
 
-    # We don't (currently) need these headers
+    # Only the extension header matters to us
     # FIXME: should we check the return key?
+    window_bits = 0
     while header:
         header = await stream.readline()
         if header == b"\r\n":
             break
-    U.log_dbg('websocket.connect', 'connected', url)
-    
-    return WebsocketClient(stream)
+        if deflate_bits and header.lower().startswith(b'sec-websocket-extensions:') and b'permessage-deflate' in header:
+            window_bits = deflate_bits
+            match = re.search(r'client_max_window_bits=(\d+)', header.decode())
+            if match:
+                window_bits = min(window_bits, int(match.group(1)))
+    U.log_dbg('websocket.connect', 'connected', url, 'deflate', window_bits)
+
+    return WebsocketClient(stream, max_size, window_bits)
 
 # open_connection with ssl support
 def _open_connection(host, port, wss=False):
     sock = None
     try:
-        ai = socket.getaddrinfo(host, port, 0, socket.SOCK_STREAM)[0]
+        ai = _resolve(host, port)
         sock = socket.socket(ai[0], ai[1], ai[2])
         sock.setblocking(False)
         try:
@@ -108,31 +188,61 @@ def _open_connection(host, port, wss=False):
             sock.close()
         raise
 
+def _resolve(host, port):
+    now = time.time()
+    hit = _dns_cache.get((host, port))
+    if hit and hit[1] > now:
+        return hit[0]
+    ai = socket.getaddrinfo(host, port, 0, socket.SOCK_STREAM)[0]
+    _dns_cache[(host, port)] = (ai, now + _DNS_TTL)
+    return ai
+
 class WebsocketClient:
-    def __init__(self, stream):
+    def __init__(self, stream, max_size=_MAX_SIZE, deflate_bits=0):
         self._stream = stream
+        self._deflate = deflate_bits # negotiated window bits, 0 when plain
+        self._compressing = deflate_bits and _can_compress() # else sends plain frames
+        self._max_size = max_size # biggest message we accept
+        self._rbuf = bytearray(_RECV_SIZE) # reassembled data message, grows up to max_size
+        self._cbuf = bytearray(125) # control frame payload
+        self._hbuf = bytearray(8) # frame header fields
+        self._mbuf = bytearray(4) # frame mask
+        self._wbuf = bytearray(_SEND_SIZE) # queued outgoing frames
+        self._wlen = 0
         self.open = True
+        self.close_code = None # code of the close frame we sent
 
     async def recv(self):
+        msg = await self.recv_view()
+        if not msg:
+            return
+        text, view = msg
+        return str(view, 'utf-8') if text else bytes(view)
+
+    async def recv_view(self):
+        # (is text, memoryview of the message), the view is only valid
+        # until the next recv, None when the connection is closed
         popcode = None # previos op code
-        buf = bytearray(0)
+        size = 0
+        compressed = False
 
         while self.open:
             try:
-                fin, opcode, data = await self._read_frame()
+                fin, rsv1, opcode, data = await self._read_frame(size)
             except EOFError:
                 self.open = False
                 return
 
             # if it's a continuation frame, it's the same data-type
             if opcode == _OP_CONT:
+                if popcode is None:
+                    raise ValueError(opcode)
                 opcode = popcode
-            else:
-                buf = bytearray(0)
+                size += len(data)
+            elif opcode == _OP_TEXT or opcode == _OP_BYTES:
                 popcode = opcode
-
-            if opcode == _OP_TEXT or opcode == _OP_BYTES:
-                buf += data
+                size = len(data)
+                compressed = bool(rsv1)
 
             elif opcode == _OP_CLOSE:
                 self.close()
@@ -148,7 +258,7 @@ class WebsocketClient:
             elif opcode == _OP_PING:
                 # We need to send a pong frame
                 self._write_frame(_OP_PONG, data)
-                await self._stream.drain()
+                await self.flush()
                 continue
 
             else:
@@ -156,18 +266,60 @@ class WebsocketClient:
                 raise ValueError(opcode)
 
             if fin:
-                # gonna leak a bit since im not clearing the buffer on exit.
-                if opcode == _OP_TEXT:
-                    return buf.decode('utf-8')
-                elif opcode == _OP_BYTES:
-                    return buf
+                if compressed:
+                    try:
+                        data = self._inflate(size)
+                    except MemoryError:
+                        data = None
+                    if data is None:
+                        # inflated past what we accept, close like an
+                        # oversized frame
+                        self.close(code=_CLOSE_TOO_BIG)
+                        await self.flush()
+                        return
+                    return opcode == _OP_TEXT, data
+                return opcode == _OP_TEXT, memoryview(self._rbuf)[:size]
+
+    def _inflate(self, size):
+        # None when the message inflates past max_size
+        if not self._deflate:
+            raise ValueError('unexpected compressed frame')
+        end = size + len(_INFLATE_TAIL)
+        self._reserve(size, end)
+        self._rbuf[size:end] = _INFLATE_TAIL
+        view = memoryview(self._rbuf)[:end]
+        # both read one byte past the limit instead of inflating it all
+        if deflate:
+            data = deflate.DeflateIO(io.BytesIO(view), deflate.RAW, self._deflate).read(self._max_size + 1)
+        else:
+            data = DecompIO(io.BytesIO(view), -self._deflate).read(self._max_size + 1)
+        if len(data) > self._max_size:
+            return None
+        return memoryview(data)
+
+    def _compress(self, buf):
+        out = io.BytesIO()
+        stream = deflate.DeflateIO(out, deflate.RAW, self._deflate)
+        stream.write(buf)
+        # final block instead of a sync flush, fine with no context takeover
+        stream.close()
+        data = out.getvalue()
+        if data.endswith(_DEFLATE_TAIL):
+            data = data[:-4]
+        return data
+
+    async def _read_frame(self, size):
+        # data frames land in _rbuf, continuations right after the
+        # `size` bytes already received, control frames in _cbuf
+        hbuf = memoryview(self._hbuf)
 
-    async def _read_frame(self):
         # Frame header
-        byte1, byte2 = struct.unpack('!BB', await self._stream.readexactly(2))
+        await self._readinto(hbuf[:2])
+        byte1, byte2 = self._hbuf[0], self._hbuf[1]
 
-        # Byte 1: FIN(1) _(1) _(1) _(1) OPCODE(4)
+        # Byte 1: FIN(1) RSV1(1) _(1) _(1) OPCODE(4)
         fin = bool(byte1 & 0x80)
+        rsv1 = byte1 & _RSV1
         opcode = byte1 & 0x0f
 
         # Byte 2: MASK(1) LENGTH(7)
@@ -175,81 +327,146 @@ class WebsocketClient:
         length = byte2 & 0x7f
 
         if length == 126:  # Magic number, length header is 2 bytes
-            length, = struct.unpack('!H', await self._stream.readexactly(2))
+            await self._readinto(hbuf[:2])
+            length, = struct.unpack_from('!H', self._hbuf, 0)
         elif length == 127:  # Magic number, length header is 8 bytes
-            length, = struct.unpack('!Q', await self._stream.readexactly(8))
+            await self._readinto(hbuf)
+            length, = struct.unpack_from('!Q', self._hbuf, 0)
 
         if mask:  # Mask is 4 bytes
-            mask_bits = await self._stream.readexactly(4)
-
-        try:
-            data = await self._stream.readexactly(length)
-        except MemoryError:
-            # We can't receive this many bytes, close the socket
-            self.close(code=_CLOSE_TOO_BIG)
-            await self._stream.drain()
-            return True, _OP_CLOSE, None
+            await self._readinto(memoryview(self._mbuf))
 
+        if opcode & 0x8: # control frame
+            if length > len(self._cbuf):
+                raise ValueError('control frame too long')
+            data = memoryview(self._cbuf)[:length]
+        else:
+            offset = size if opcode == _OP_CONT else 0
+            if offset + length > self._max_size:
+                # We won't receive this many bytes, close the socket
+                self.close(code=_CLOSE_TOO_BIG)
+                await self.flush()
+                return True, 0, _OP_CLOSE, None
+            try:
+                self._reserve(offset, offset + length)
+            except MemoryError:
+                # We can't receive this many bytes, close the socket
+                self.close(code=_CLOSE_TOO_BIG)
+                await self.flush()
+                return True, 0, _OP_CLOSE, None
+            data = memoryview(self._rbuf)[offset:offset + length]
+
+        await self._readinto(data)
         if mask:
-            data = bytes(b ^ mask_bits[i % 4] for i, b in enumerate(data))
+            _mask(data, self._mbuf, length)
+
+        return fin, rsv1, opcode, data
 
-        return fin, opcode, data
+    def _reserve(self, keep, need):
+        # grow the receive buffer once to fit `need`, keeping `keep` bytes
+        if need <= len(self._rbuf):
+            return
+        rbuf = bytearray(max(need, min(self._max_size, len(self._rbuf) * 2)))
+        rbuf[:keep] = memoryview(self._rbuf)[:keep]
+        self._rbuf = rbuf
+
+    async def _readinto(self, view):
+        pos = 0
+        while pos < len(view):
+            count = await self._stream.readinto(view[pos:])
+            if count is None: # nothing buffered in the tls layer yet
+                continue
+            if not count:
+                raise EOFError()
+            pos += count
 
-    async def send(self, buf):
+    async def send(self, buf, flush=True):
+        # flush=False only queues the frame, the next flush sends
+        # every queued frame with a single write
         if not self.open:
             return
 
         if isinstance(buf, str):
             opcode = _OP_TEXT
             buf = buf.encode('utf-8')
-        elif isinstance(buf, bytes):
+        elif isinstance(buf, (bytes, bytearray, memoryview)):
             opcode = _OP_BYTES
         else:
             raise TypeError('invalid buf type')
 
-        self._write_frame(opcode, buf)
+        rsv1 = 0
+        if self._compressing and len(buf) >= _DEFLATE_MIN:
+            buf = self._compress(buf)
+            rsv1 = _RSV1
+
+        self._write_frame(opcode, buf, rsv1)
+        if flush:
+            await self.flush()
+
+    async def flush(self):
+        if self._wlen:
+            self._stream.write(memoryview(self._wbuf)[:self._wlen])
+            self._wlen = 0
         await self._stream.drain()
 
-    def _write_frame(self, opcode, data=b''):
+    def _write_frame(self, opcode, data=b'', rsv1=0):
+        # append the whole frame to the output buffer
         fin = True
         mask = True
         length = len(data)
 
         # Frame header
-        # Byte 1: FIN(1) _(1) _(1) _(1) OPCODE(4)
+        # Byte 1: FIN(1) RSV1(1) _(1) _(1) OPCODE(4)
         byte1 = 0x80 if fin else 0
-        byte1 |= opcode
+        byte1 |= rsv1 | opcode
 
         # Byte 2: MASK(1) LENGTH(7)
         byte2 = 0x80 if mask else 0
 
         if length < 126:  # 126 is magic value to use 2-byte length header
             byte2 |= length
-            self._stream.write(struct.pack('!BB', byte1, byte2))
-
+            fmt = '!BB'
         elif length < (1 << 16):  # Length fits in 2-bytes
             byte2 |= 126  # Magic code
-            self._stream.write(struct.pack('!BBH', byte1, byte2, length))
-
+            fmt = '!BBH'
         elif length < (1 << 64):
             byte2 |= 127  # Magic code
-            self._stream.write(struct.pack('!BBQ', byte1, byte2, length))
-
+            fmt = '!BBQ'
         else:
             raise ValueError('invalid length')
 
+        head = struct.calcsize(fmt)
+        pos = self._wlen
+        end = pos + head + (4 if mask else 0) + length
+        if end > len(self._wbuf):
+            wbuf = bytearray(max(end, len(self._wbuf) * 2))
+            wbuf[:pos] = memoryview(self._wbuf)[:pos]
+            self._wbuf = wbuf
+        wbuf = memoryview(self._wbuf)
+
+        if length < 126:
+            struct.pack_into(fmt, self._wbuf, pos, byte1, byte2)
+        else:
+            struct.pack_into(fmt, self._wbuf, pos, byte1, byte2, length)
+        pos += head
+
         if mask:  # Mask is 4 bytes
-            mask_bits = struct.pack('!I', random.getrandbits(32))
-            self._stream.write(mask_bits)
-            data = bytes(b ^ mask_bits[i % 4] for i, b in enumerate(data))
+            struct.pack_into('!I', self._wbuf, pos, random.getrandbits(32))
+            mask_bits = wbuf[pos:pos + 4]
+            pos += 4
+            wbuf[pos:end] = data
+            _mask(wbuf[pos:end], mask_bits, length)
+        else:
+            wbuf[pos:end] = data
 
-        self._stream.write(data)
+        self._wlen = end
 
-    def close(self, code=_CLOSE_OK, reason=''):
+    def close(self, code=CLOSE_OK, reason=''):
         '''Close the websocket.  Must call await websocket.wait_closed after'''
         if not self.open:
             return
 
+        self.close_code = code
         buf = struct.pack('!H', code) + reason.encode('utf-8')
 
         self._write_frame(_OP_CLOSE, buf)
@@ -258,5 +475,5 @@ class WebsocketClient:
     async def wait_closed(self):
         # drain stream to send off any final frames
         # close the stream (and underlying connection)
-        await self._stream.drain()
+        await self.flush()
         await self._stream.wait_closed()
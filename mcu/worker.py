@@ -6,6 +6,7 @@ import uasyncio as asio
 import utils as U
 import net_utils as N
 from config2 import config2
+from metrics import metrics
 
 _WORKER_TICK = const(20) # seconds
 _WORKER_OFFSET = const(120) # seconds
@@ -25,46 +26,62 @@ class Worker:
                 timestamp = time.time()
                 await asio.sleep(max(1, _WORKER_TICK - timestamp % _WORKER_TICK))
 
-                year, month, day, _, hour, minute = U.rtc.datetime()[:6]
-                date = "%04d-%02d-%02d" % (year, month, day)
+                year, month, day, _, hour, minute, second = U.rtc.datetime()[:7]
+                begin = time.ticks_ms()
                 time_prev = time_now
                 time_now = hour * 60 + minute
 
-                change = False
-                for name, dev in config2.devices.items():
-                        wakeup = dev.check_startup(date, time_prev, time_now)
-                        if wakeup and not self._monitor.devices.get(name):
-                            U.log_dbg('Worker.run', name, config2.days.get(date), 'wakeup')
-                            for _ in range(0, 3):
-                                await N.send_wol(dev.mac)
-                                await asio.sleep(1)
-                            change = True
-                            continue
-
-                        shutdown = dev.check_shutdown(date, time_prev, time_now)
-                        if shutdown and self._monitor.devices.get(name):
-                            U.log_dbg('Worker.run', name, config2.days.get(date), 'shutdown')
-                            for _ in range(0, 3):
-                                await N.send_shutdown(dev.ip)
-                                await asio.sleep(1)
-                            change = True
-                            continue
-
-                        if dev.has_schedule():
-                            U.log_dbg('Worker.run', name, config2.days.get(date), 'ignore')
-
-                if change:
-                    self._monitor.busy_event.set()
+                day_type = config2.days.get(year, month, day)
+                due = [(sign, name) for sign, name in config2.due(day_type, time_prev, time_now) if name in config2.devices]
+                if not due:
+                    continue
+
+                # act on a fresh ping, not on a state up to minutes old
+                names = list(set(name for _, name in due))
+                online = dict(zip(names, await self._monitor.fresh(names)))
+
+                wakeups = []
+                shutdowns = []
+                touched = []
+                woken = set()
+                for sign, name in due:
+                    dev = config2.devices.get(name)
+                    if not dev:
+                        continue
+
+                    if sign == '+':
+                        if dev.wol and not online[name]:
+                            U.log_dbg('Worker.run', name, day_type, 'wakeup')
+                            wakeups.append(dev.wol)
+                            touched.append(name)
+                            woken.add(name)
+                        else:
+                            U.log_dbg('Worker.run', name, day_type, 'ignore')
+
+                    elif name not in woken:
+                        # one lost reply must not skip a shutdown, the
+                        # confirmed state still counts
+                        if online[name] or self._monitor.devices.get(name):
+                            U.log_dbg('Worker.run', name, day_type, 'shutdown')
+                            shutdowns.append(dev.ip)
+                            touched.append(name)
+                        else:
+                            U.log_dbg('Worker.run', name, day_type, 'ignore')
+
+                if wakeups or shutdowns:
+                    await N.send_burst(wakeups, shutdowns)
+                    # from the start of the minute the tick landed in
+                    metrics.observe('dispatch_ms', second * 1000 + time.ticks_diff(time.ticks_ms(), begin))
+                    metrics.incr('dispatches', len(touched))
+                    self._monitor.watch(touched)
                     gc.collect()
 
         except Exception as ex:
             U.log_err('Worker.run', ex)
             raise
 
-    async def do(self, pkt):
+    async def do(self, opt, data):
         try:
-            opt = pkt.get('type')
-            data = pkt.get('data')
             if not data:
                 return
             name = data.get('name')
@@ -79,13 +96,22 @@ class Worker:
 
             if opt == 'wakeup':
                 U.log_info('Worker._by_remote', 'wakeup', name)
-                await N.send_wol(dev.mac)
+                if not dev.wol:
+                    U.log_err('Worker._by_remote', 'invalid mac', name)
+                    return
+                if (await self._monitor.fresh((name,)))[0]:
+                    U.log_info('Worker._by_remote', 'already online', name)
+                    return
+                await N.send_wol(dev.wol)
 
             elif opt == 'shutdown':
                 U.log_info('Worker._by_remote', 'shutdown', name)
                 await N.send_shutdown(dev.ip)
 
-            self._monitor.busy_event.set()
+            # from the server sending the command, seconds resolution
+            metrics.observe('dispatch_ms', max(0, N.epoch_now() - time) * 1000)
+            metrics.incr('dispatches')
+            self._monitor.watch((name,))
             gc.collect()
 
         except Exception as ex:
@@ -1,5 +1,5 @@
 import Ajv from 'ajv';
-import { WebSocketServer, WebSocket } from 'ws';
+import { WebSocketServer, WebSocket, RawData } from 'ws';
 import { DEVICES } from './config';
 import * as log from './log';
 import * as token from './token';
@@ -8,23 +8,82 @@ import * as wsvr from './web-server';
 
 const HEARTBEAT_INTERVAL = 120 * 1000;
 const CLIENT_TIMEOUT = 180 * 1000;
+const CONFIG_SYNC_INTERVAL = 3600 * 1000;
 
 const ajv = new Ajv();
 
+// the MCU inflates with a small window and keeps no context between messages
+const DEFLATE_WINDOW_BITS = 10;
+
 export const wsServer = new WebSocketServer({
   noServer: true,
+  perMessageDeflate: {
+    serverNoContextTakeover: true,
+    clientNoContextTakeover: true,
+    serverMaxWindowBits: DEFLATE_WINDOW_BITS,
+    clientMaxWindowBits: DEFLATE_WINDOW_BITS,
+    threshold: 256,
+  },
 });
 
 let wsClient: WebSocket | null = null;
 let clientIp: string = '';
 let clientLast: number;
 
+type Devices = typeof DEVICES;
+type Days = Array<{ date: string, type: string }>;
+type ClientConfig = { version: number, devices: Devices, days: Days };
+type ConfigPatch = {
+  base: number,
+  version: number,
+  devices: { set: Devices, del: Array<string> },
+  days: { set: Days, del: Array<string> },
+};
+type Histogram = { le: Array<number>, counts: Array<number>, count: number, sum: number, max: number };
+type ClientStats = {
+  time: number,
+  uptime: number,
+  counters: Record<string, number>,
+  gauges: Record<string, number>,
+  histograms: Record<string, Histogram>,
+  rtt: Record<string, number>, // by device name
+};
+type Discovery = {
+  id: number,
+  started: number,
+  done: boolean,
+  hosts: Array<{ ip: string, name?: string }>, // name when configured
+};
+
+// config versions start from the boot time so they never repeat across restarts
+let configVersion = Math.floor(Date.now() / 1000);
+// config the client holds, patches are computed against it
+let configSent: ClientConfig | null = null;
+// last runtime metrics the client pushed
+let clientStats: ClientStats | null = null;
+// last subnet discovery, filled in as the client streams batches
+let discovery: Discovery | null = null;
+let discoveryId = 0;
+// seconds after which an unfinished discovery is given up, the client may
+// have dropped the link mid-sweep
+const DISCOVERY_TIMEOUT = 120;
+
 setInterval(() => {
   if (wsClient) {
     wsClient.send(`{"type":"heartbeat", "data": "${'0'.repeat(32)}"}`);
   }
 }, HEARTBEAT_INTERVAL);
 
+setInterval(async () => {
+  try {
+    if (wsClient) {
+      await syncConfig();
+    }
+  } catch (err) {
+    log.error('client-ws.syncConfig', err);
+  }
+}, CONFIG_SYNC_INTERVAL);
+
 export function isConnected() {
   return !!wsClient && Date.now() - clientLast < CLIENT_TIMEOUT;
 }
@@ -43,6 +102,20 @@ export function getLastTime() {
   return clientLast / 1000;
 }
 
+export function getStats() {
+  return clientStats;
+}
+
+export function getDiscovery() {
+  return discovery;
+}
+
+// the client runs one sweep at a time and ignores a discover meanwhile
+export function isDiscovering() {
+  return discovery !== null && !discovery.done
+    && Date.now() / 1000 - discovery.started < DISCOVERY_TIMEOUT;
+}
+
 wsServer.on('connection', async function onConnection(ws, req) {
   const ip = req.headers['wom-ip'] as any;
   log.info('client-ws.onConnection', 'connection incoming', ip);
@@ -65,16 +138,32 @@ wsServer.on('connection', async function onConnection(ws, req) {
   wsClient.on('close', function onClose() {
     if (this === wsClient) {
       wsClient = null;
+      configSent = null;
     }
     log.info('client-ws.onClose', 'remote closed');
   });
 
   wsClient.on('message', async function onMessage(pkt, isBinary) {
     try {
-      if (!isBinary) {
+      if (isBinary) {
+        const buf = toBuffer(pkt);
+        if (buf[0] === REPORT_BINARY) {
+          await onBinaryReport(buf);
+        } else {
+          log.error('client-ws.onMessage', `invalid binary message ${buf.toString('hex')}`);
+        }
+      } else {
         const msg = JSON.parse(pkt.toString());
         if (msg?.type === 'report') {
           await onReport(msg);
+        } else if (msg?.type === 'stats') {
+          await onStats(msg);
+        } else if (msg?.type === 'discovered') {
+          await onDiscovered(msg);
+        } else if (msg?.type === 'config_resync') {
+          log.info('client-ws.onMessage', 'config resync', msg.data);
+          configSent = null;
+          await config();
         } else {
           log.error('client-ws.onMessage', `invalid message ${JSON.stringify(msg)}`);
         }
@@ -122,12 +211,66 @@ function makeReceive<F extends Function>(schema: any, func: F) {
 }
 
 const config = makeSend('config', 1, async () => {
-  return {
-    devices: DEVICES,
+  configSent = {
+    version: ++configVersion,
+    devices: cloneDevices(),
     days: await svc.queryDays(7),
   };
+  return configSent;
+});
+
+const configPatch = makeSend('config_patch', 1, async (patch: ConfigPatch, next: ClientConfig) => {
+  configSent = next;
+  return patch;
 });
 
+export async function syncConfig() {
+  if (!configSent) {
+    await config();
+    return;
+  }
+  const devices = cloneDevices();
+  const days = await svc.queryDays(7);
+  const patch = diffConfig(configSent, devices, days);
+  if (patch) {
+    await configPatch(patch, { version: patch.version, devices, days });
+  }
+}
+
+function diffConfig(base: ClientConfig, devices: Devices, days: Days): ConfigPatch | null {
+  const setDevices: Devices = {};
+  const delDevices: Array<string> = [];
+  for (const [name, dev] of Object.entries(devices)) {
+    if (JSON.stringify(base.devices[name]) !== JSON.stringify(dev)) {
+      setDevices[name] = dev;
+    }
+  }
+  for (const name of Object.keys(base.devices)) {
+    if (!devices[name]) {
+      delDevices.push(name);
+    }
+  }
+
+  const baseDays = new Map(base.days.map(({ date, type }) => [date, type]));
+  const nextDays = new Set(days.map(({ date }) => date));
+  const setDays = days.filter(({ date, type }) => baseDays.get(date) !== type);
+  const delDays = base.days.map(({ date }) => date).filter((date) => !nextDays.has(date));
+
+  if (!Object.keys(setDevices).length && !delDevices.length && !setDays.length && !delDays.length) {
+    return null;
+  }
+  return {
+    base: base.version,
+    version: ++configVersion,
+    devices: { set: setDevices, del: delDevices },
+    days: { set: setDays, del: delDays },
+  };
+}
+
+function cloneDevices(): Devices {
+  return JSON.parse(JSON.stringify(DEVICES));
+}
+
 const onReport = makeReceive({
   type: "object",
   additionalProperties: {
@@ -141,6 +284,98 @@ const onReport = makeReceive({
   await wsvr.sendInfos();
 });
 
+const onStats = makeReceive({
+  type: "object",
+  required: ["uptime", "counters", "gauges", "histograms", "rtt"],
+  properties: {
+    uptime: { type: "number" },
+    counters: { type: "object", additionalProperties: { type: "number" } },
+    gauges: { type: "object", additionalProperties: { type: "number" } },
+    histograms: {
+      type: "object",
+      additionalProperties: {
+        type: "object",
+        required: ["le", "counts", "count", "sum", "max"],
+        properties: {
+          le: { type: "array", items: { type: "number" } },
+          counts: { type: "array", items: { type: "number" } },
+          count: { type: "number" },
+          sum: { type: "number" },
+          max: { type: "number" },
+        },
+      },
+    },
+    rtt: { type: "object", additionalProperties: { type: "number" } },
+  },
+}, async (data: any) => {
+  // the client reports round trips by ip, the web side knows devices by name
+  const rtt: Record<string, number> = {};
+  for (const dev of Object.values(DEVICES)) {
+    if (typeof data.rtt[dev.ip] === 'number') {
+      rtt[dev.name] = data.rtt[dev.ip];
+    }
+  }
+  clientStats = { ...data, rtt, time: Date.now() / 1000 };
+  clientLast = Date.now();
+  await wsvr.sendInfos();
+});
+
+const onDiscovered = makeReceive({
+  type: "object",
+  required: ["id", "ips", "done"],
+  properties: {
+    id: { type: "number" },
+    ips: { type: "array", items: { type: "string" } },
+    done: { type: "boolean" },
+  },
+}, async (data: any) => {
+  if (!discovery || discovery.id !== data.id) {
+    throw new Error(`Discovery ${data.id} not requested`);
+  }
+  const names = new Map(Object.values(DEVICES).map((dev) => [dev.ip, dev.name]));
+  for (const ip of data.ips) {
+    discovery.hosts.push({ ip, name: names.get(ip) });
+  }
+  discovery.done = data.done;
+  clientLast = Date.now();
+});
+
+// binary report: type(1) config version(4) count(2) online bitset,
+// bit i is the i-th device name in utf-8 byte order, lowest bit first
+const REPORT_BINARY = 0x01;
+const REPORT_HEADER = 7;
+
+async function onBinaryReport(buf: Buffer) {
+  const version = buf.readUInt32BE(1);
+  const count = buf.readUInt16BE(5);
+  if (!configSent || configSent.version !== version) {
+    throw new Error(`Report for unknown config version ${version}`);
+  }
+  const names = Object.keys(configSent.devices)
+    .sort((a, b) => Buffer.compare(Buffer.from(a), Buffer.from(b)));
+  if (names.length !== count || buf.length < REPORT_HEADER + Math.ceil(count / 8)) {
+    throw new Error(`Invalid binary report ${buf.toString('hex')}`);
+  }
+  log.debug('client-ws.onBinaryReport recv', buf.toString('hex'));
+
+  for (let i = 0; i < count; i++) {
+    const running = (buf[REPORT_HEADER + (i >> 3)] >> (i & 7)) & 1;
+    await svc.updateDevice(names[i], running ? 'running' : 'stopped');
+  }
+  clientLast = Date.now();
+  await wsvr.sendInfos();
+}
+
+function toBuffer(data: RawData): Buffer {
+  if (Buffer.isBuffer(data)) {
+    return data;
+  }
+  if (Array.isArray(data)) {
+    return Buffer.concat(data);
+  }
+  return Buffer.from(data);
+}
+
 export const wakeup = makeSend('wakeup', 2, async (name: string) => {
   await svc.updateWakeup(name);
   return {
@@ -149,6 +384,18 @@ export const wakeup = makeSend('wakeup', 2, async (name: string) => {
   };
 });
 
+export const discover = makeSend('discover', 1, async () => {
+  discovery = {
+    id: ++discoveryId,
+    started: Date.now() / 1000,
+    done: false,
+    hosts: [],
+  };
+  return {
+    id: discovery.id,
+  };
+});
+
 export const shutdown = makeSend('shutdown', 2, async (name: string) => {
   await svc.updateShutdown(name);
   return {
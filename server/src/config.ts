@@ -22,6 +22,7 @@ export const DEVICES: Record<string, {
   workday?: Array<string>,
   holiday?: Array<string>,
   anyday?: Array<string>,
+  probe?: string, // icmp, tcp:<port> or both comma separated, defaults to icmp
 }> = {};
 for (const dev of C.DEVICES || []) {
   if (dev.name && dev.ip) {
@@ -33,6 +34,7 @@ for (const dev of C.DEVICES || []) {
       workday: dev.workday || undefined,
       holiday: dev.holiday || undefined,
       anyday: dev.anyday || undefined,
+      probe: dev.probe || undefined,
     };
   }
 }
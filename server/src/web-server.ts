@@ -48,6 +48,7 @@ async function makeInfos() {
       ip: csvr.getIpAddress(),
       status: csvr.isConnected() ? "online" : "offline",
       last: csvr.getLastTime(),
+      stats: csvr.getStats(),
     },
     devices: (await svc.listDevices())
       .map((dev) => ({
@@ -113,6 +114,38 @@ http.post('/command/shutdown', async (req, res) => {
   }
 });
 
+http.post('/command/discover', async (_req, res) => {
+  try {
+    if (csvr.isDiscovering()) {
+      res.status(409);
+      res.json({ error: 'Discovery running' });
+      log.error('/command/discover', 409);
+      return;
+    }
+
+    await csvr.discover();
+    res.json({ error: null });
+    log.info('/command/discover');
+
+  } catch (err) {
+    res.status(500);
+    res.json({ error: 'Server inner error' });
+    log.error('/command/discover', err);
+  }
+});
+
+http.get('/discovery', async (_req, res) => {
+  try {
+    res.json(csvr.getDiscovery() || {});
+    log.info('/discovery');
+
+  } catch (err) {
+    res.status(500);
+    res.json({ error: 'Server inner error' });
+    log.error('/discovery', err);
+  }
+});
+
 export const wsServer = new WebSocketServer({
   noServer: true,
 });
@@ -0,0 +1,418 @@
+# benchmarks of the firmware hot paths on a simulated lan
+#
+#   python3 sim/bench.py [--hosts 200] [--seed 1] [--json]
+#
+# time below is virtual, a simulated sweep or dispatch takes as long as
+# it would on the lan. cpu, lag and alloc are measured on the host and
+# only comparable between runs on the same machine. lag is the longest
+# loop step, alloc the peak traced memory of one sweep.
+
+import argparse
+import asyncio
+import calendar
+import json
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+from errno import EAGAIN
+
+_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[:0] = [os.path.join(_ROOT, 'sim', 'stubs'), os.path.join(_ROOT, 'mcu'), os.path.join(_ROOT, 'sim')]
+
+import lan as L
+
+_clock = L.Clock(calendar.timegm((2024, 1, 1, 7, 58, 0)))
+_clock.install()
+
+import utils as U
+import net_utils as N
+import jsonstream as J
+from config2 import config2
+from monitor import Monitor
+from worker import Worker
+
+U.print = lambda *args, **kwargs: None # keep the firmware logs quiet
+
+_WAKE_AT = 8 * 60 # minutes, the schedule under test
+
+def _build(args, hosts, schedule=False):
+    seed, up, latency, loss = args.seed, args.up, args.latency, args.loss
+    firewalled, probe = args.firewalled, not args.icmp_only
+    _clock.now = 0.0
+    loop = L.VirtualLoop(_clock)
+    asyncio.set_event_loop(loop)
+    lan = L.Lan(loop, seed)
+    devices = {}
+    for idx in range(hosts):
+        ip = '10.0.%d.%d' % (idx // 250, idx % 250 + 2)
+        mac = '02:00:00:00:%02x:%02x' % (idx >> 8, idx & 0xFF)
+        host = lan.add(L.Host(ip, mac, lan.rng.random() < up, lan.rng.uniform(latency / 2, latency * 2), loss))
+        device = {'name': 'host%03d' % idx, 'ip': ip, 'mac': mac}
+        if lan.rng.random() < firewalled:
+            # drops icmp like a default windows firewall, rdp still answers
+            host.icmp = False
+            host.ports = (3389,)
+            device['probe'] = 'icmp,tcp:3389' if probe else 'icmp'
+        if schedule:
+            host.up = False
+            device['anyday'] = ['+%d:%02d' % (_WAKE_AT // 60, _WAKE_AT % 60)]
+        devices[device['name']] = device
+
+    config = {'devices': devices, 'days': [{'date': '2024-01-01', 'type': 'workday'}], 'version': 1}
+    config2._apply(J.JsonReader(J.chunks(json.dumps(config))))
+    L.attach(N, lan)
+    return loop, lan
+
+class _Probe:
+    # wraps net_utils.ping_sweep to time every sweep the firmware makes
+    def __init__(self, loop):
+        self._loop = loop
+        self._sweep = N.ping_sweep
+        self.durations = []
+        self.peaks = []
+        N.ping_sweep = self
+
+    async def __call__(self, ips, *args):
+        tracemalloc.reset_peak()
+        base = tracemalloc.get_traced_memory()[0]
+        started = self._loop.time()
+        results = await self._sweep(ips, *args)
+        self.durations.append(self._loop.time() - started)
+        self.peaks.append(tracemalloc.get_traced_memory()[1] - base)
+        return results
+
+    def restore(self):
+        N.ping_sweep = self._sweep
+
+class _Server:
+    def __init__(self, loop):
+        self._loop = loop
+        self.reports = 0
+        self.seen = {} # name -> virtual time first reported online
+
+    async def send(self, pkt, flush=True):
+        self.reports += 1
+        for name, online in pkt['data'].items():
+            if online and name not in self.seen:
+                self.seen[name] = self._loop.time()
+        return True
+
+def _close(loop):
+    # let the pinger reader and every firmware task unwind before closing
+    N.pinger.close()
+    tasks = asyncio.all_tasks(loop)
+    for task in tasks:
+        task.cancel()
+    loop.run_until_complete(asyncio.gather(*tasks, return_exceptions=True))
+    loop.close()
+
+def _percentile(values, quantile):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * quantile))]
+
+def _loop_stats(loop):
+    return {
+        'lag_p99_ms': loop.stats.lag(0.99) * 1000,
+        'lag_max_ms': loop.stats.lag(1.0) * 1000,
+        'cpu_ms': loop.stats.busy * 1000,
+    }
+
+def bench_sweep(args):
+    # full sweeps of every host through the shared pinger
+    loop, lan = _build(args, args.hosts)
+    ips = [dev.target() for dev in config2.devices.values()]
+    expected = sum(1 for host in lan.hosts.values() if host.up)
+    probe = _Probe(loop)
+    answered = []
+    unprobed = []
+
+    async def run():
+        for _ in range(args.rounds):
+            results = await N.ping_sweep(ips)
+            answered.append(sum(1 for reply in results if reply))
+            unprobed.append(sum(1 for reply in results if reply is None))
+
+    try:
+        loop.run_until_complete(run())
+    finally:
+        probe.restore()
+        _close(loop)
+
+    result = {
+        'hosts': len(ips),
+        'up': expected,
+        'answered': min(answered),
+        'unprobed': max(unprobed),
+        'sweep_s': _percentile(probe.durations, 0.5),
+        'alloc_kb': max(probe.peaks) / 1024,
+        'peak_sockets': lan.peak_sockets,
+    }
+    result.update(_loop_stats(loop))
+    return result
+
+def bench_monitor(args):
+    # the monitor alone for a while, probes and reports it generates
+    loop, lan = _build(args, args.hosts)
+    probe = _Probe(loop)
+    server = _Server(loop)
+    monitor = Monitor()
+    monitor._server = server
+
+    async def run():
+        asyncio.ensure_future(monitor._ping_devices())
+        await asyncio.sleep(args.minutes * 60)
+
+    try:
+        loop.run_until_complete(run())
+    finally:
+        probe.restore()
+        _close(loop)
+
+    result = {
+        'minutes': args.minutes,
+        'sweeps': len(probe.durations),
+        'probes': lan.icmp_sent + lan.tcp_sent,
+        'probes_per_host_min': (lan.icmp_sent + lan.tcp_sent) / (args.hosts * args.minutes),
+        'reports': server.reports,
+        'sweep_p50_s': _percentile(probe.durations, 0.5),
+        'sweep_max_s': max(probe.durations or [0]),
+        'alloc_kb': max(probe.peaks or [0]) / 1024,
+    }
+    result.update(_loop_stats(loop))
+    return result
+
+def bench_wake(args):
+    # every host is off and scheduled to wake at 8:00, measures the time
+    # from the schedule boundary to the wol and to the report it is up
+    hosts = min(args.hosts, args.wake_hosts)
+    loop, lan = _build(args, hosts, schedule=True)
+    server = _Server(loop)
+    monitor = Monitor()
+    worker = Worker()
+    boundary = calendar.timegm((2024, 1, 1, _WAKE_AT // 60, _WAKE_AT % 60, 0)) - _clock.base
+
+    async def run():
+        asyncio.ensure_future(monitor.run(server))
+        asyncio.ensure_future(worker.run(monitor))
+        await asyncio.sleep(boundary + args.minutes * 60)
+
+    try:
+        loop.run_until_complete(run())
+    finally:
+        _close(loop)
+
+    wol = [host.woken_at - boundary for host in lan.hosts.values() if host.woken_at is not None]
+    names = dict((dev.ip, name) for name, dev in config2.devices.items())
+    seen = [server.seen[names[host.ip]] - host.up_at for host in lan.hosts.values()
+            if host.up_at is not None and names[host.ip] in server.seen]
+    result = {
+        'hosts': hosts,
+        'woken': len(wol),
+        'dispatch_p50_s': _percentile(wol, 0.5),
+        'dispatch_max_s': max(wol or [0]),
+        'detect_p50_s': _percentile(seen, 0.5),
+        'detect_max_s': max(seen or [0]),
+        'reports': server.reports,
+    }
+    result.update(_loop_stats(loop))
+    return result
+
+def bench_discover(args):
+    # discovery of the /24 the board sits in, 10.0.0.0 holds the first
+    # 250 hosts of the lan
+    loop, lan = _build(args, args.hosts)
+    N.MASK = '255.255.255.0'
+    expected = sum(1 for host in lan.hosts.values() if host.up and host.icmp and host.ip.startswith('10.0.0.'))
+    batches = []
+    found = []
+
+    async def send(ips, done):
+        batches.append(loop.time())
+        found.extend(ips)
+
+    try:
+        loop.run_until_complete(N.discover(send))
+    finally:
+        _close(loop)
+
+    result = {
+        'up': expected,
+        'found': len(found),
+        'batches': len(batches),
+        'first_batch_s': batches[0],
+        'duration_s': batches[-1],
+    }
+    result.update(_loop_stats(loop))
+    return result
+
+async def _poll_ping(lan, ip):
+    # a re-creation of the sleep-polling ping the pinger replaced, one
+    # readinto every 100 ms, not the old do_ping itself
+    sock = lan.socket(L.AF_INET, L.SOCK_RAW, 1)
+    try:
+        packet = bytearray(N.PING_SIZE)
+        packet[0] = 8
+        sock.sendto(packet, (ip, 1))
+        for _ in range(0, 30):
+            try:
+                sock.readinto(bytearray(256))
+                return True
+            except OSError as err:
+                if err.errno != EAGAIN:
+                    raise
+                await asyncio.sleep(0.1)
+        return False
+    finally:
+        sock.close()
+
+def bench_loopback(args):
+    # a simulation of scheduling only: lan.attach swaps the io queue
+    # waits of net_utils for events on the simulated sockets, so neither
+    # the poller nor a real socket is involved. the virtual time a ping
+    # takes is how long the control flow leaves a landed reply unread,
+    # 0 for the pinger, up to the poll interval for the reference
+    loop, lan = _build(args, 1)
+    host = next(iter(lan.hosts.values()))
+    host.up, host.icmp, host.latency, host.loss = True, True, 0.0, 0.0
+    replies = {'pinger': [], 'poll': []}
+    walls = {}
+
+    async def run():
+        for name, ping in (('pinger', N.do_ping), ('poll', lambda ip: _poll_ping(lan, ip))):
+            wall = time.perf_counter()
+            for _ in range(args.pings):
+                begin = loop.time()
+                if await ping(host.ip):
+                    replies[name].append(loop.time() - begin)
+            walls[name] = time.perf_counter() - wall
+
+    try:
+        loop.run_until_complete(run())
+    finally:
+        _close(loop)
+
+    result = {'pings': args.pings}
+    for name in ('pinger', 'poll'):
+        result['%s_replies' % name] = len(replies[name])
+        result['%s_reply_p50_ms' % name] = _percentile(replies[name], 0.5) * 1000
+        result['%s_reply_max_ms' % name] = max(replies[name] or [0]) * 1000
+        result['%s_us_per_ping' % name] = walls[name] / args.pings * 1000000
+    return result
+
+class _Flash:
+    # a log file that counts writes and flushes, each flush spins for the
+    # cost of a flash program so it shows in the loop lag
+    def __init__(self, path, mode, stats, cost):
+        self._file = open(path, mode)
+        self._stats = stats
+        self._cost = cost
+
+    def write(self, text):
+        self._stats['bytes'] += len(text)
+        return self._file.write(text)
+
+    def flush(self):
+        self._stats['flushes'] += 1
+        end = time.perf_counter() + self._cost
+        while time.perf_counter() < end:
+            pass
+        self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+def bench_logging(args):
+    # bursts of log lines for a while, flushed after every line like the
+    # logger used to against the batched log_writer
+    result = {'lines': args.log_rate * args.minutes * 60}
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as tmp:
+        os.chdir(tmp)
+        try:
+            for name in ('per_line', 'batched'):
+                stats = {'bytes': 0, 'flushes': 0}
+                U.open = lambda path, mode: _Flash(path, mode, stats, args.flash_ms / 1000)
+                U._ring_event = asyncio.Event()
+                U._file, U._file_size, U.log_dropped = None, 0, 0
+                _clock.now = 0.0
+                loop = L.VirtualLoop(_clock)
+                asyncio.set_event_loop(loop)
+
+                async def run():
+                    if name == 'batched':
+                        asyncio.ensure_future(U.log_writer())
+                    for second in range(args.minutes * 60):
+                        for idx in range(args.log_rate):
+                            U.log_info('bench', 'line', second, idx)
+                            if name == 'per_line':
+                                U.log_flush()
+                        await asyncio.sleep(1)
+                    U.log_flush()
+
+                try:
+                    loop.run_until_complete(run())
+                finally:
+                    _close(loop)
+                    U._file.close()
+                    for path in os.listdir(tmp):
+                        os.remove(path)
+
+                result['%s_flushes' % name] = stats['flushes']
+                result['%s_kb' % name] = stats['bytes'] / 1024
+                result['%s_lag_p99_ms' % name] = loop.stats.lag(0.99) * 1000
+                result['%s_lag_max_ms' % name] = loop.stats.lag(1.0) * 1000
+        finally:
+            os.chdir(cwd)
+            del U.open
+            U._file = None
+    return result
+
+_BENCHES = (
+    ('loopback', bench_loopback),
+    ('sweep', bench_sweep),
+    ('monitor', bench_monitor),
+    ('wake', bench_wake),
+    ('discover', bench_discover),
+    ('logging', bench_logging),
+)
+
+def main():
+    parser = argparse.ArgumentParser(description='wake-on-mcu firmware benchmarks on a simulated lan')
+    parser.add_argument('--hosts', type=int, default=200)
+    parser.add_argument('--wake-hosts', type=int, default=50, help='hosts in the wake benchmark')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--up', type=float, default=0.7, help='share of hosts powered on')
+    parser.add_argument('--latency', type=float, default=0.005, help='mean one-way latency, seconds')
+    parser.add_argument('--loss', type=float, default=0.01, help='packet loss each way')
+    parser.add_argument('--firewalled', type=float, default=0.0, help='share of hosts dropping icmp, probed over tcp')
+    parser.add_argument('--icmp-only', action='store_true', help='probe firewalled hosts with icmp alone')
+    parser.add_argument('--rounds', type=int, default=5, help='sweeps in the sweep benchmark')
+    parser.add_argument('--pings', type=int, default=1000, help='pings in the loopback benchmark, a scheduling simulation')
+    parser.add_argument('--log-rate', type=int, default=4, help='log lines a second in the logging benchmark')
+    parser.add_argument('--flash-ms', type=float, default=2.0, help='cost of one flash write in the logging benchmark')
+    parser.add_argument('--minutes', type=int, default=30, help='virtual minutes of the monitor and wake benchmarks')
+    parser.add_argument('--only', choices=[name for name, _ in _BENCHES])
+    parser.add_argument('--json', action='store_true', help='print one json object for tracking')
+    args = parser.parse_args()
+
+    tracemalloc.start()
+    results = {}
+    for name, bench in _BENCHES:
+        if args.only and args.only != name:
+            continue
+        results[name] = bench(args)
+        if not args.json:
+            print('%-8s %s' % (name, '  '.join('%s=%s' % (key, _format(value)) for key, value in results[name].items())))
+
+    if args.json:
+        print(json.dumps(results, sort_keys=True))
+
+def _format(value):
+    return '%.3f' % value if isinstance(value, float) else str(value)
+
+if __name__ == '__main__':
+    main()
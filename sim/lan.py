@@ -0,0 +1,271 @@
+# simulated lan for running the firmware on the host: a virtual clock
+# driving asyncio, hosts with latency, loss and power state, and sockets
+# that answer icmp echo, tcp connects, wake-on-lan and shutdown packets
+
+import asyncio
+import collections
+import random
+import time
+from errno import EAGAIN, EALREADY, ECONNREFUSED, EINPROGRESS
+
+AF_INET = 2
+SOCK_STREAM = 1
+SOCK_DGRAM = 2
+SOCK_RAW = 3
+
+_WOL_PORT = 9
+_SHUTDOWN_PORT = 40004
+_SHUTDOWN_PACKET = b'wom_shutdown'
+_EISCONN = 127 # esp-idf newlib value for connecting a connected socket
+_ENFILE = 23 # socket table full
+
+class Clock:
+    # virtual seconds since `base`, the loop jumps it forward instead of
+    # sleeping so a simulated hour takes as long as its cpu work
+    def __init__(self, base):
+        self.base = base
+        self.now = 0.0
+
+    def install(self):
+        time.time = lambda: int(self.base + self.now)
+        time.ticks_ms = lambda: int(self.now * 1000)
+        time.ticks_us = lambda: int(self.now * 1000000)
+        time.ticks_diff = lambda new, old: new - old
+        time.ticks_add = lambda ticks, delta: ticks + delta
+
+class _Selector:
+    # polls the real selector without blocking, a wait advances the clock,
+    # the wall time between two polls is one loop step and counts as lag
+    def __init__(self, selector, clock, stats):
+        self._selector = selector
+        self._clock = clock
+        self._stats = stats
+        self._mark = None
+
+    def select(self, timeout=None):
+        if self._mark is not None:
+            self._stats.step(time.perf_counter() - self._mark)
+        events = self._selector.select(0)
+        if not events:
+            if timeout is None:
+                raise RuntimeError('simulation stalled, nothing scheduled')
+            self._clock.now += timeout
+        self._mark = time.perf_counter()
+        return events
+
+    def __getattr__(self, name):
+        return getattr(self._selector, name)
+
+class LoopStats:
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.steps = 0
+        self.busy = 0.0
+        self.lags = []
+
+    def step(self, seconds):
+        self.steps += 1
+        self.busy += seconds
+        self.lags.append(seconds)
+
+    def lag(self, quantile):
+        if not self.lags:
+            return 0.0
+        lags = sorted(self.lags)
+        return lags[min(len(lags) - 1, int(len(lags) * quantile))]
+
+class VirtualLoop(asyncio.SelectorEventLoop):
+    def __init__(self, clock):
+        super().__init__()
+        self.clock = clock
+        self.stats = LoopStats()
+        self._selector = _Selector(self._selector, clock, self.stats)
+
+    def time(self):
+        return self.clock.now
+
+class Host:
+    def __init__(self, ip, mac, up=True, latency=0.005, loss=0.0, boot=30.0, halt=10.0, icmp=True, ports=()):
+        self.ip = ip
+        self.mac = mac
+        self.up = up
+        self.icmp = icmp # answers echo requests, firewalled hosts drop them
+        self.ports = ports # listening tcp ports, others answer with rst
+        self.latency = latency # seconds, one way
+        self.loss = loss # probability a packet is lost each way
+        self.boot = boot # seconds from wol to answering pings
+        self.halt = halt # seconds from shutdown to silence
+        self.woken_at = None # first wol received
+        self.up_at = None
+        self.halted_at = None # first shutdown received
+        self.down_at = None
+        self._changing = False
+
+    def mac_bin(self):
+        return bytes(int(part, 16) for part in self.mac.split(':'))
+
+class Lan:
+    AF_INET = AF_INET
+    SOCK_STREAM = SOCK_STREAM
+    SOCK_DGRAM = SOCK_DGRAM
+    SOCK_RAW = SOCK_RAW
+
+    def __init__(self, loop, seed=1, sockets=10):
+        self.loop = loop
+        self.sockets = sockets # open sockets allowed, lwip's table on esp-idf holds 10
+        self.open_sockets = 0
+        self.peak_sockets = 0
+        self.rng = random.Random(seed)
+        self.hosts = {} # ip -> Host
+        self._macs = {} # mac bytes -> Host
+        self.icmp_sent = 0
+        self.icmp_answered = 0
+        self.tcp_sent = 0
+        self.udp_sent = 0
+
+    def add(self, host):
+        self.hosts[host.ip] = host
+        self._macs[host.mac_bin()] = host
+        return host
+
+    # socket module interface, net_utils.socket is pointed at the lan
+    def socket(self, family=AF_INET, kind=SOCK_STREAM, proto=0):
+        if self.open_sockets >= self.sockets:
+            raise OSError(_ENFILE, 'ENFILE')
+        self.open_sockets += 1
+        self.peak_sockets = max(self.peak_sockets, self.open_sockets)
+        return SimSocket(self, kind)
+
+    def getaddrinfo(self, host, port, *args):
+        return [(AF_INET, SOCK_STREAM, 0, '', (host, port))]
+
+    def _lost(self, host):
+        return host.loss and self.rng.random() < host.loss
+
+    def _icmp(self, sock, buf, ip):
+        self.icmp_sent += 1
+        host = self.hosts.get(ip)
+        if not host or not host.up or not host.icmp or buf[0] != 8 or self._lost(host) or self._lost(host):
+            return
+        self.icmp_answered += 1
+        # reply with an ip header in front like a raw socket read
+        reply = bytearray(20 + len(buf))
+        reply[0] = 0x45
+        reply[20:] = buf
+        reply[20] = 0 # ICMP_ECHO_REPLY
+        delay = 2 * host.latency * (0.5 + self.rng.random())
+        self.loop.call_later(delay, sock._deliver, bytes(reply))
+
+    def _tcp(self, sock, addr):
+        # the syn-ack or rst comes back after a round trip, a host that is
+        # off or loses the packet leaves the connect pending
+        self.tcp_sent += 1
+        ip, port = addr
+        host = self.hosts.get(ip)
+        if not host or not host.up or self._lost(host) or self._lost(host):
+            return
+        result = _EISCONN if port in host.ports else ECONNREFUSED
+        delay = 2 * host.latency * (0.5 + self.rng.random())
+        self.loop.call_later(delay, sock._connected, result)
+
+    def _udp(self, buf, addr):
+        self.udp_sent += 1
+        ip, port = addr
+        if port == _WOL_PORT and len(buf) == 102 and buf[:6] == b'\xff' * 6:
+            host = self._macs.get(bytes(buf[6:12]))
+            if host and host.woken_at is None:
+                host.woken_at = self.loop.time()
+            if host and not host.up and not host._changing:
+                host._changing = True
+                self.loop.call_later(host.boot, self._power, host, True)
+        elif port == _SHUTDOWN_PORT and bytes(buf) == _SHUTDOWN_PACKET:
+            host = self.hosts.get(ip)
+            if host and host.halted_at is None:
+                host.halted_at = self.loop.time()
+            if host and host.up and not host._changing:
+                host._changing = True
+                self.loop.call_later(host.halt, self._power, host, False)
+
+    def _power(self, host, up):
+        host.up = up
+        host._changing = False
+        if up:
+            host.up_at = self.loop.time()
+        else:
+            host.down_at = self.loop.time()
+
+class SimSocket:
+    def __init__(self, lan, kind):
+        self._lan = lan
+        self._kind = kind
+        self._queue = collections.deque()
+        self._ready = asyncio.Event()
+        self._connect = None # errno the next connect raises
+        self.closed = False
+
+    def setblocking(self, flag):
+        pass
+
+    def settimeout(self, value):
+        pass
+
+    def connect(self, addr):
+        if self._connect is None:
+            self._connect = EALREADY
+            self._lan._tcp(self, addr)
+            raise OSError(EINPROGRESS, 'EINPROGRESS')
+        raise OSError(self._connect, 'connect')
+
+    def sendto(self, buf, addr):
+        if self.closed:
+            raise OSError(9, 'closed')
+        if self._kind == SOCK_RAW:
+            self._lan._icmp(self, bytes(buf), addr[0])
+        else:
+            self._lan._udp(bytes(buf), addr)
+        return len(buf)
+
+    def readinto(self, buf):
+        if not self._queue:
+            self._ready.clear()
+            raise OSError(EAGAIN, 'EAGAIN')
+        packet = self._queue.popleft()
+        size = min(len(buf), len(packet))
+        buf[:size] = packet[:size]
+        return size
+
+    def close(self):
+        if not self.closed:
+            self._lan.open_sockets -= 1
+        self.closed = True
+        self._ready.set() # let a parked reader see the close
+
+    def _connected(self, result):
+        if not self.closed:
+            self._connect = result
+            self._ready.set()
+
+    def _deliver(self, packet):
+        if not self.closed:
+            self._queue.append(packet)
+            self._ready.set()
+
+async def _wait_read(sock):
+    await sock._ready.wait()
+
+async def _wait_write(sock):
+    # datagrams always go out, a stream is writable once connected
+    if sock._kind == SOCK_STREAM:
+        await sock._ready.wait()
+
+def attach(net_utils, lan):
+    # route the firmware's sockets and poller waits through the lan
+    net_utils.socket = lan
+    net_utils._wait_read = _wait_read
+    net_utils._wait_write = _wait_write
+    net_utils.IP, net_utils.MASK = '10.0.0.1', '255.255.0.0'
+    net_utils.BOARDCAST = '10.0.255.255'
+    net_utils.pinger = net_utils.Pinger()
+    net_utils._tcp_slots = net_utils._Slots(net_utils._TCP_LIMIT)
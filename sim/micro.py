@@ -0,0 +1,459 @@
+# micro benchmarks of pure firmware functions on the host, each result is
+# checked against a reference implementation before it is timed
+#
+#   python3 sim/micro.py [--only name] [--json]
+#
+# times are wall clock on the host, only comparable between runs on the
+# same machine, the ratio to the reference is what carries over
+
+import argparse
+import asyncio
+import collections
+import gc
+import json
+import os
+import random
+import struct
+import sys
+import tempfile
+import time
+import tracemalloc
+import zlib
+
+_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[:0] = [os.path.join(_ROOT, 'sim', 'stubs'), os.path.join(_ROOT, 'mcu')]
+
+import utils as U
+import jsonstream as J
+import config2 as C2
+import config as C
+import net_utils as N
+import websocket as W
+import monitor as M
+
+U.print = lambda *args, **kwargs: None # keep the firmware logs quiet
+
+def _timeit(fn, number):
+    # best of 5 runs, seconds per call
+    best = None
+    for _ in range(5):
+        begin = time.perf_counter()
+        for _ in range(number):
+            fn()
+        spent = (time.perf_counter() - begin) / number
+        best = spent if best is None or spent < best else best
+    return best
+
+def _schedule(rng):
+    rules = []
+    for _ in range(rng.randint(1, 4)):
+        rules.append('%s%d:%02d' % (rng.choice('+-'), rng.randint(0, 23), rng.randint(0, 59)))
+    return rules
+
+def _config(devices, seed):
+    rng = random.Random(seed)
+    config = {'devices': {}, 'days': [], 'version': 1}
+    for idx in range(devices):
+        device = {'name': 'host%03d' % idx, 'ip': '10.0.%d.%d' % (idx // 250, idx % 250 + 2),
+            'mac': '02:00:00:00:%02x:%02x' % (idx >> 8, idx & 0xFF)}
+        for day_type in ('workday', 'holiday', 'anyday'):
+            if rng.random() < 0.5:
+                device[day_type] = _schedule(rng)
+        config['devices'][device['name']] = device
+    for month in range(1, 13):
+        for day in range(1, 29, 3):
+            config['days'].append({'date': '2024-%02d-%02d' % (month, day), 'type': rng.choice(('workday', 'holiday'))})
+    return config
+
+def _load(config):
+    C2.config2._apply(J.JsonReader(J.chunks(json.dumps(config))))
+    return C2.config2
+
+def bench_timeline(args):
+    # a day of worker ticks, bisect over the compiled timelines against
+    # the per-device rule scan they replaced
+    config2 = _load(_config(args.devices, args.seed))
+    windows = [(day_type, minute - 1, minute) for day_type in ('workday', 'holiday', None) for minute in range(0, 1440)]
+
+    def scan():
+        found = []
+        for day_type, prev, now in windows:
+            for name, dev in config2.devices.items():
+                for sign, mins in dev.times(day_type) or ():
+                    if prev < mins <= now:
+                        found.append((day_type, sign, name))
+        return found
+
+    def bisect():
+        found = []
+        for day_type, prev, now in windows:
+            for sign, name in config2.due(day_type, prev, now):
+                found.append((day_type, sign, name))
+        return found
+
+    if collections.Counter(scan()) != collections.Counter(bisect()):
+        raise AssertionError('timeline: due events differ from the rule scan')
+    return {
+        'devices': args.devices,
+        'ticks': len(windows),
+        'events': len(bisect()),
+        'scan_us_per_tick': _timeit(scan, 1) / len(windows) * 1000000,
+        'bisect_us_per_tick': _timeit(bisect, 1) / len(windows) * 1000000,
+    }
+
+def _peak(fn):
+    # peak traced bytes above what was live before the call, and what the
+    # call left live
+    gc.collect()
+    tracemalloc.start()
+    base = tracemalloc.get_traced_memory()[0]
+    kept = fn()
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del kept
+    return peak - base, current - base
+
+def bench_calendar(args):
+    # a year of day types decoded from json, kept as the dict of date
+    # strings config2 used to hold against the Calendar bitmaps
+    rng = random.Random(args.seed)
+    text = json.dumps([{'date': '2024-%02d-%02d' % C2._month_day(2024, yday), 'type': rng.choice(('workday', 'holiday'))}
+        for yday in range(366)])
+
+    def as_dict():
+        return dict((day['date'], day['type']) for day in json.loads(text))
+
+    def as_calendar():
+        days = C2.Calendar()
+        for day in json.loads(text):
+            days.set(day['date'], day['type'])
+        return days
+
+    def decode():
+        json.loads(text)
+
+    days, calendar = as_dict(), as_calendar()
+    for date, day_type in days.items():
+        if calendar.get(int(date[0:4]), int(date[5:7]), int(date[8:10])) != day_type:
+            raise AssertionError('calendar: %s differs from the dict' % date)
+    # what json.loads leaves behind in the interpreter's free lists is
+    # not held by either structure
+    residue = _peak(decode)[1]
+    return {
+        'days': len(days),
+        'dict_kb': (_peak(as_dict)[1] - residue) / 1024,
+        'calendar_kb': (_peak(as_calendar)[1] - residue) / 1024,
+    }
+
+def _push(view):
+    # what Server._recv does with a config push, streamed into config2
+    reader = J.JsonReader(J.chunks(view))
+    for key in reader.items():
+        if key == 'data':
+            C2.config2._apply(reader)
+            break
+        reader.value()
+    return C2.config2.devices
+
+def bench_config_mem(args):
+    # a config push as the server sends it, decoded into one dict and
+    # built into devices and days from it like _recv and _apply used to,
+    # against streaming it straight into config2
+    config = _config(args.devices, args.seed)
+    msg = json.dumps({'type': 'config', 'data': config}).encode()
+
+    def decoded():
+        obj = json.loads(msg)
+        devices = dict((name, C2.Device(item)) for name, item in obj['data']['devices'].items())
+        days = dict((item['date'], item['type']) for item in obj['data']['days'])
+        return obj, devices, days
+
+    def streamed():
+        return _push(memoryview(msg))
+
+    if _load(config).devices.keys() != set(config['devices']):
+        raise AssertionError('config_mem: devices differ from the config')
+    decoded_peak, decoded_kept = _peak(decoded)
+    streamed_peak, streamed_kept = _peak(streamed)
+    return {
+        'devices': args.devices,
+        'msg_kb': len(msg) / 1024,
+        'decoded_peak_kb': decoded_peak / 1024,
+        'decoded_kept_kb': decoded_kept / 1024,
+        'streamed_peak_kb': streamed_peak / 1024,
+        'streamed_kept_kb': streamed_kept / 1024,
+    }
+
+class _DecompIO:
+    # zlib.DecompIO of the older ports over the host zlib, websocket falls
+    # back to it without the deflate module
+    def __init__(self, stream, wbits):
+        self._stream = stream
+        self._inflater = zlib.decompressobj(wbits)
+
+    def read(self, size):
+        return self._inflater.decompress(self._stream.read(), size)
+
+class _Stream:
+    # the part of uasyncio.stream.Stream a WebsocketClient uses, reads
+    # from one buffer and keeps what is written
+    def __init__(self, data):
+        self._data = memoryview(data)
+        self._pos = 0
+        self.written = bytearray()
+
+    async def readinto(self, view):
+        count = min(len(view), len(self._data) - self._pos)
+        view[:count] = self._data[self._pos:self._pos + count]
+        self._pos += count
+        return count
+
+    def write(self, buf):
+        self.written += buf
+
+    async def drain(self):
+        pass
+
+    async def wait_closed(self):
+        pass
+
+def _deflated(msg, bits):
+    # compressed like the server does, sync flushed with the tail cut
+    compressor = zlib.compressobj(6, zlib.DEFLATED, -bits)
+    wire = compressor.compress(msg) + compressor.flush(zlib.Z_SYNC_FLUSH)
+    return wire[:-4] if wire.endswith(b'\x00\x00\xff\xff') else wire
+
+def _frame(payload, rsv1):
+    # one unmasked text frame from the server
+    head = bytes((0x81 | (0x40 if rsv1 else 0),))
+    if len(payload) < 126:
+        return head + bytes((len(payload),)) + payload
+    if len(payload) < 1 << 16:
+        return head + struct.pack('!BH', 126, len(payload)) + payload
+    return head + struct.pack('!BQ', 127, len(payload)) + payload
+
+def bench_deflate(args):
+    # a config push over permessage-deflate as the server compresses it,
+    # bytes on the wire and time from the received frame to config2
+    # against the plain frame, at the firmware's message limit
+    if not W.deflate:
+        W.DecompIO = _DecompIO
+    bits = C.WS_DEFLATE_BITS
+    msg = json.dumps({'type': 'config', 'data': _config(args.devices, args.seed)}).encode()
+    wire = _deflated(msg, bits)
+    if len(msg) > C.WS_MAX_MESSAGE:
+        raise AssertionError('deflate: %d devices do not fit WS_MAX_MESSAGE' % args.devices)
+
+    loop = asyncio.new_event_loop()
+    try:
+        def receive(frame):
+            client = W.WebsocketClient(_Stream(frame), C.WS_MAX_MESSAGE, bits)
+            return client, loop.run_until_complete(client.recv_view())
+
+        def inflated():
+            return _push(receive(_frame(wire, True))[1][1])
+
+        def plain():
+            return _push(receive(_frame(msg, False))[1][1])
+
+        if bytes(receive(_frame(wire, True))[1][1]) != msg:
+            raise AssertionError('deflate: inflated message differs from the plain one')
+
+        # a push inflating past the limit closes with 1009 instead of raising
+        devices = args.devices
+        while True:
+            devices *= 2
+            big = json.dumps({'type': 'config', 'data': _config(devices, args.seed)}).encode()
+            if len(big) > C.WS_MAX_MESSAGE:
+                break
+        client, received = receive(_frame(_deflated(big, bits), True))
+        if received is not None or client.close_code != 1009:
+            raise AssertionError('deflate: oversized push not closed with 1009')
+        return {
+            'devices': args.devices,
+            'plain_bytes': len(msg),
+            'wire_bytes': len(wire),
+            'ratio': len(wire) / len(msg),
+            'plain_apply_ms': _timeit(plain, 1) * 1000,
+            'inflate_apply_ms': _timeit(inflated, 1) * 1000,
+            'oversize_devices': devices,
+        }
+    finally:
+        loop.close()
+
+def bench_snapshot(args):
+    # the boot time config load, the binary snapshot against the json
+    # file read in chunks, both as Config2.load reads them
+    _load(_config(args.devices, args.seed))
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as tmp:
+        os.chdir(tmp)
+        try:
+            C2.config2._write_snapshot()
+            C2.config2._dump()
+            sizes = (os.stat(C2._SNAPSHOT_FILE)[6], os.stat(C2._CONFIG_FILE)[6])
+
+            def from_snapshot():
+                config = C2.Config2()
+                if not config._read_snapshot():
+                    raise AssertionError('snapshot: unreadable')
+                return config
+
+            def from_json():
+                config = C2.Config2()
+                with open(C2._CONFIG_FILE, 'rb') as file:
+                    config._apply(J.JsonReader(lambda: file.read(C2._READ_CHUNK)))
+                return config
+
+            snapshot, dumped = from_snapshot(), from_json()
+            if repr(snapshot.devices) != repr(dumped.devices) or repr(snapshot.days) != repr(dumped.days) \
+                    or snapshot.revision != dumped.revision:
+                raise AssertionError('snapshot: config differs from the json')
+            return {
+                'devices': args.devices,
+                'snapshot_kb': sizes[0] / 1024,
+                'json_kb': sizes[1] / 1024,
+                'snapshot_ms': _timeit(from_snapshot, 1) * 1000,
+                'json_ms': _timeit(from_json, 1) * 1000,
+            }
+        finally:
+            os.chdir(cwd)
+
+def bench_report(args):
+    # one report cycle, the bitset against the json object of every
+    # device name, both as the bytes Server.send hands the websocket
+    config2 = _load(_config(args.report_devices, args.seed))
+    rng = random.Random(args.seed)
+    monitor = M.Monitor()
+    monitor.devices = dict((name, rng.random() < 0.7) for name in config2.order)
+
+    def as_json():
+        return json.dumps({'type': 'report', 'data': monitor.devices}).encode()
+
+    def as_binary():
+        return monitor._encode_report()
+
+    binary = as_binary()
+    head = struct.calcsize(M._REPORT_HEADER)
+    decoded = dict((name, bool(binary[head + (idx >> 3)] >> (idx & 0x7) & 1)) for idx, name in enumerate(config2.order))
+    if decoded != monitor.devices or json.loads(as_json())['data'] != monitor.devices:
+        raise AssertionError('report: decoded states differ from the monitor')
+    return {
+        'devices': args.report_devices,
+        'json_bytes': len(as_json()),
+        'binary_bytes': len(binary),
+        'json_us': _timeit(as_json, 1000) * 1000000,
+        'binary_us': _timeit(as_binary, 1000) * 1000000,
+    }
+
+def _compute_checksum(data):
+    # the per-packet checksum the template replaced, kept as the reference
+    if len(data) & 0x1: # Odd number of bytes
+        data += b'\0'
+    cs = 0
+    for pos in range(0, len(data), 2):
+        b1 = data[pos]
+        b2 = data[pos + 1]
+        cs += (b1 << 8) + b2
+    while cs >= 0x10000:
+        cs = (cs & 0xffff) + (cs >> 16)
+    cs = ~cs & 0xffff
+    return cs
+
+def bench_checksum(args):
+    # _ones_sum over random buffers and the presummed echo template over
+    # random seq and timestamps, both against the reference checksum
+    rng = random.Random(args.seed)
+    for _ in range(args.cases):
+        data = bytes(rng.getrandbits(8) for _ in range(rng.randint(0, 80)))
+        if ~N._ones_sum(data) & 0xffff != _compute_checksum(data):
+            raise AssertionError('checksum: _ones_sum differs on %s' % data.hex())
+
+    pinger = N.Pinger()
+    sbuf = pinger._sbuf
+    edges = [(0, 0), (0xFFFF, 0xFFFFFFFF), (0xFFFF, 0), (0, 0xFFFFFFFF)]
+    for seq, stamp in edges + [(rng.getrandbits(16), rng.getrandbits(32)) for _ in range(args.cases)]:
+        pinger._fill(seq, stamp)
+        if _compute_checksum(sbuf) != 0:
+            raise AssertionError('checksum: template wrong for seq %d stamp %d' % (seq, stamp))
+
+    def full():
+        struct.pack_into(N._PING_STAMP, sbuf, 6, 1, 0x12345678)
+        sbuf[2] = sbuf[3] = 0
+        cs = _compute_checksum(sbuf)
+        sbuf[2] = cs >> 8
+        sbuf[3] = cs & 0xFF
+
+    def template():
+        pinger._fill(1, 0x12345678)
+
+    return {
+        'cases': args.cases,
+        'full_us': _timeit(full, 1000) * 1000000,
+        'template_us': _timeit(template, 1000) * 1000000,
+    }
+
+def bench_mask(args):
+    # in-place masking of a frame payload against the generator that built
+    # a new bytes per frame. on the host _mask is the python fallback and
+    # runs about as fast, what carries over is the allocation per frame
+    rng = random.Random(args.seed)
+    mask_bits = bytes(rng.getrandbits(8) for _ in range(4))
+    result = {'impl': W._mask.__module__}
+    for size in (64, 1024, 16384):
+        data = bytes(rng.getrandbits(8) for _ in range(size))
+        buf = bytearray(data)
+
+        def generator():
+            return bytes(b ^ mask_bits[i % 4] for i, b in enumerate(data))
+
+        def in_place():
+            W._mask(memoryview(buf), mask_bits, size)
+
+        in_place()
+        if bytes(buf) != generator():
+            raise AssertionError('mask: %d byte payload differs from the generator' % size)
+        number = max(1, 16384 // size)
+        result['generator_us_%d' % size] = _timeit(generator, number) * 1000000
+        result['in_place_us_%d' % size] = _timeit(in_place, number) * 1000000
+        result['generator_alloc_%d' % size] = _peak(generator)[0]
+        result['in_place_alloc_%d' % size] = _peak(in_place)[0]
+    return result
+
+_BENCHES = (
+    ('timeline', bench_timeline),
+    ('calendar', bench_calendar),
+    ('config_mem', bench_config_mem),
+    ('snapshot', bench_snapshot),
+    ('report', bench_report),
+    ('checksum', bench_checksum),
+    ('mask', bench_mask),
+    ('deflate', bench_deflate),
+)
+
+def main():
+    parser = argparse.ArgumentParser(description='wake-on-mcu firmware micro benchmarks')
+    parser.add_argument('--devices', type=int, default=300)
+    parser.add_argument('--report-devices', type=int, default=100, help='devices in the report benchmark')
+    parser.add_argument('--cases', type=int, default=10000, help='random cases checked in the checksum benchmark')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--only', choices=[name for name, _ in _BENCHES])
+    parser.add_argument('--json', action='store_true', help='print one json object for tracking')
+    args = parser.parse_args()
+
+    results = {}
+    for name, bench in _BENCHES:
+        if args.only and args.only != name:
+            continue
+        results[name] = bench(args)
+        if not args.json:
+            print('%-10s %s' % (name, '  '.join('%s=%s' % (key, _format(value)) for key, value in results[name].items())))
+
+    if args.json:
+        print(json.dumps(results, sort_keys=True))
+
+def _format(value):
+    return '%.3f' % value if isinstance(value, float) else str(value)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,27 @@
+# host stand-in for machine, the rtc follows time.time() so it runs on
+# the simulation clock once sim.lan has installed it
+import time
+
+class RTC:
+    def datetime(self, *args):
+        if args:
+            return None
+        tm = time.gmtime(int(time.time()))
+        return (tm[0], tm[1], tm[2], tm[6], tm[3], tm[4], tm[5], 0)
+
+class Pin:
+    OUT = 1
+    IN = 0
+
+    def __init__(self, *args, **kwargs):
+        pass
+
+class PWM:
+    def __init__(self, *args, **kwargs):
+        pass
+
+    def duty(self, *args):
+        return 0
+
+def reset():
+    raise SystemExit('machine.reset')
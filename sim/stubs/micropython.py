@@ -0,0 +1,10 @@
+# host stand-in for the micropython module
+
+def const(value):
+    return value
+
+def native(fn):
+    return fn
+
+def viper(fn):
+    return fn
@@ -0,0 +1,21 @@
+# host stand-in for network, always connected to the simulated lan
+STA_IF = 0
+
+class WLAN:
+    def __init__(self, *args):
+        pass
+
+    def active(self, *args):
+        return True
+
+    def scan(self):
+        return []
+
+    def isconnected(self):
+        return True
+
+    def connect(self, *args):
+        pass
+
+    def ifconfig(self):
+        return ('10.0.0.1', '255.255.0.0', '10.0.0.254', '10.0.0.254')
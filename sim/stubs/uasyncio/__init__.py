@@ -0,0 +1,8 @@
+# host stand-in for uasyncio on top of asyncio
+from asyncio import *
+
+async def sleep_ms(ms):
+    await sleep(ms / 1000)
+
+async def wait_for_ms(aw, ms):
+    return await wait_for(aw, ms / 1000)
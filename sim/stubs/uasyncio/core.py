@@ -0,0 +1,3 @@
+# the io queue is micropython only, sim.lan replaces the socket waits
+# of net_utils with awaits on the simulated sockets
+_io_queue = None
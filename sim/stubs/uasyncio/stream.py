@@ -0,0 +1,4 @@
+# streams are micropython only, the host benchmarks import websocket for
+# its pure functions and never open a connection
+class Stream:
+    pass